@@ -15,7 +15,7 @@ True
 3
 """
 
-from .code import _level, _parents, split
+from .code import split
 from .database import (
     Database,
     AmbiguousRegionError, InvalidCodeError, RegionKeyError,
@@ -25,9 +25,12 @@ __all__ = [
     'AmbiguousRegionError',
     'InvalidCodeError',
     'RegionKeyError',
+    'from_isolike',
+    'is_valid',
     'isolike',
     'level',
     'parent',
+    'parent_many',
     'split',
     'within',
     ]
@@ -44,18 +47,43 @@ def isolike(code, prefix='CN-'):
     GB/T 2260 two-letter alpha codes for province-level divisions (e.g. 'BJ'),
     and three-letter alpha codes for lower divisions, separated by hyphens:
 
-    >>> alpha(130100)
+    >>> isolike(130100)
     'CN-HE-SJW'
 
     For divisions below level 2, no official alpha codes are provided, so
-    :meth:`alpha` raises :py:class:`ValueError`.
+    :meth:`isolike` raises :py:class:`ValueError`. For codes not in the
+    database, raises :class:`InvalidCodeError`.
+
+    See also :meth:`.Database.isolike_many`.
     """
-    parts = [d.alpha for d in divisions.stack(code)]
+    return divisions.isolike(code, prefix)
+
+
+def from_isolike(value, prefix='CN-'):
+    """Return the code for an 'ISO 3166-2-like' alpha code *value*.
+
+    The inverse of :meth:`isolike`:
 
-    if None in parts:
-        raise ValueError('no alpha code for %d', code)
+    >>> from_isolike('CN-HE-SJW')
+    130100
+
+    If *value* is not the code of any division, raises
+    :class:`RegionKeyError`. See also :meth:`.Database.from_isolike_many`.
+    """
+    return divisions.from_isolike(value, prefix).code
 
-    return prefix + '-'.join(parts)
+
+def is_valid(code):
+    """Return :py:data:`True` if *code* is the code of a division.
+
+    >>> is_valid(110108)
+    True
+    >>> is_valid(990000)
+    False
+
+    See also :meth:`.Database.valid_mask`, to check many codes at once.
+    """
+    return divisions.is_valid(code)
 
 
 def level(code):
@@ -82,34 +110,25 @@ def parent(code, parent_level=None):
     >>> parent(110108, 1)
     110000
 
+    See also :meth:`.Database.parent`.
     """
-    l = _level(code)
-    parents_guess = _parents(code)
+    return divisions.parent(code, parent_level)
 
-    parents_db = divisions.stack(code)
 
-    # try:
-    #     parents_db = _select(['code'], 'code in (?, ?, ?) ORDER BY code',
-    #                          parents_guess, list)
-    # except LookupError:
-    #     raise InvalidCodeError('%d and its parents %s' %
-    #                            (code, parents_guess[:2]))
+def parent_many(codes, parent_level=None):
+    """Return the parents of many *codes*, and a mask of errors.
 
-    if code not in parents_db:
-        raise InvalidCodeError(code)
+    Like :meth:`parent`, but an invalid code or missing parent gives a parent
+    of 0 and sets the error mask, instead of raising an exception:
 
-    if parent_level is None:
-        parent_level = l - 1
+    >>> parents, errors = parent_many([110108, 990101], 1)
+    >>> list(parents), list(errors)
+    ([110000, 0], [0, 1])
 
-    if parent_level not in (1, 2, 3):
-        raise ValueError('level = %d' % parent_level)
-
-    guess = parents_guess[parent_level - 1]
-    if guess not in parents_db:
-        raise ValueError('code %d is at level %d, no parent at level %d' %
-                         (code, l, parent_level))
-    else:
-        return guess
+    For NumPy arrays of codes, the results are NumPy arrays. See
+    :meth:`.Database.parent_many`.
+    """
+    return divisions.parent_many(codes, parent_level)
 
 
 def within(a, b):
@@ -1,11 +1,12 @@
 import argparse
+import json
 
 from .admin import URLS, refresh_cache, update
 
 parser = argparse.ArgumentParser(description=__doc__)
 parser.add_argument('action', metavar='ACTION',
-                    choices=['update', 'refresh-cache'],
-                    help='action to perform: either update or refresh-cache')
+                    choices=['update', 'refresh-cache', 'serve'],
+                    help='action to perform: update, refresh-cache or serve')
 parser.add_argument('--version', choices=sorted(URLS.keys()),
                     help='version to update the database with')
 parser.add_argument('--cached', action='store_true',
@@ -13,11 +14,26 @@ parser.add_argument('--cached', action='store_true',
                          'website')
 parser.add_argument('--verbose', action='store_true',
                     help='give verbose output')
+parser.add_argument('--profile', action='store_true',
+                    help='print the time, memory use and number of records of '
+                         'each stage of update, as JSON')
+parser.add_argument('--host', default='127.0.0.1',
+                    help='address for serve to listen on')
+parser.add_argument('--port', type=int, default=2260,
+                    help='port for serve to listen on')
+parser.add_argument('--report', type=float, default=60, metavar='SECONDS',
+                    help='interval for serve to log throughput; 0 to disable')
 
 args = parser.parse_args()
 
 
 if args.action == 'update':
-    update(args.version, use_cache=args.cached, verbose=args.verbose)
+    stages = update(args.version, use_cache=args.cached, verbose=args.verbose,
+                    profile=args.profile)
+    if args.profile:
+        print(json.dumps(stages, indent=2))
 elif args.action == 'refresh-cache':
     refresh_cache()
+elif args.action == 'serve':
+    from .server import serve
+    serve(args.host, args.port, args.report)
@@ -1,15 +1,20 @@
+from collections import Counter, OrderedDict
 import csv
 import logging
+from operator import itemgetter
 from os import linesep
 import os.path
 import re
 import sqlite3
+from zlib import crc32
 
 import jianfan
 from xpinyin import Pinyin
 
 from .code import _parents
-from .database import COLUMNS, SUFFIXES, data_fn
+from .database import COLUMNS, SUFFIXES, _arrow_table, _temp_file, data_fn
+from .instrument import Profile
+from .merge import Source, join, merge
 
 log = logging.getLogger(__name__)
 
@@ -25,45 +30,55 @@ URLS = {
 _prefix = 'http://www.stats.gov.cn/tjsj/tjbz/xzqhdm/'
 URLS = {k: _prefix + v for k, v in URLS.items()}
 
+#: Types of fields in the CSV files in ``data/``, used by :meth:`iter_csv`,
+#: :meth:`load_columns` and :meth:`load_csv`. Empty values in these fields are
+#: read as :py:data:`None`.
+SCHEMA = {
+    'code': int,
+    'level': int,
+    'alpha': str,
+    'latitude': float,
+    'longitude': float,
+    }
 
-def _configure_log(verbose=False):
-    """Return a logger, at the :py:data:`logging.DEBUG` level if *verbose*."""
-    logging.basicConfig(format='%(name)s: %(message)s',
-                        level=logging.DEBUG if verbose else logging.INFO)
-
+#: Rules for merging sources in :meth:`update`. For each field, the name of a
+#: policy in :data:`gb2260.merge.POLICIES` and the names of sources, in order
+#: of precedence: the NBS list ('nbs'), CITAS ('citas'), GB/T 2260-2007
+#: ('gbt') and ``extra.csv`` ('extra').
+MERGE_FIELDS = OrderedDict([
+    ('name_zh', ('first', ['nbs'])),
+    ('level', ('first', ['nbs'])),
+    ('name_pinyin', ('first', ['citas'])),
+    ('name_en', ('first', ['extra', 'gbt', 'citas'])),
+    ('alpha', ('present', ['extra', 'gbt'])),
+    ('latitude', ('first', ['gbt'])),
+    ('longitude', ('first', ['gbt'])),
+    ])
+
+# Fields of the CITAS table used in the merge
+_CITAS_FIELDS = {
+    'name_en': lambda row: row['N-local'].replace('`', "'"),
+    'name_pinyin': lambda row: row['N-pinyin'].replace('`', "'"),
+    }
 
-def _dict_update(a, b, conflict='raise'):
-    """Like dict.update(), but with conflict checking.
+# Settings for bulk loading in write_sqlite(). These are safe because the
+# database is written to a temporary file that is discarded on any error.
+_BULK_PRAGMAS = [
+    'journal_mode = OFF',
+    'synchronous = OFF',
+    'locking_mode = EXCLUSIVE',
+    'temp_store = MEMORY',
+    'cache_size = -65536',
+    ]
 
-    dict *a* is updated with the items of *b*. Where the same key exists in
-    both dicts, but the corresponding values differ, the result is defined by
-    the value of *conflict*:
+# Columns of the codes table that receive a secondary index
+_INDEXED_COLUMNS = ['name_zh', 'level', 'name_pinyin', 'name_en', 'alpha']
 
-    - 'raise' (default): a ValueError is raised.
-    - 'squash': the entry in *a* is replaced with the entry in *b*.
-    - 'discard': the entry in *a* is retained.
-    - any callable object: *conflict* is called with arguments (a[k], b[k], k),
-      where k is the conflicting key. Then, depending on the returned value:
-      - True: the entry in *a* is replaced with the entry in *b* (squash)
-      - False: the entry in *a* is retained (discard)
 
-    On any other value for *conflict*, a ValueError is raised.
-    """
-    for k, v in b.items():
-        if k in a and a[k] != v:  # Conflict
-            if conflict == 'raise':
-                raise ValueError('Value %s for key %s would conflict with '
-                                 'existing value %s ', v, k, a[k])
-            elif conflict == 'squash':
-                pass
-            elif conflict == 'discard':
-                continue
-            elif callable(conflict):
-                if not conflict(a[k], v, k):
-                    continue
-            else:
-                raise ValueError('Cannot handle conflict with %s', conflict)
-        a[k] = v
+def _configure_log(verbose=False):
+    """Return a logger, at the :py:data:`logging.DEBUG` level if *verbose*."""
+    logging.basicConfig(format='%(name)s: %(message)s',
+                        level=logging.DEBUG if verbose else logging.INFO)
 
 
 def _match_names(official, other):
@@ -81,47 +96,130 @@ def _match_names(official, other):
         return False
 
 
+def _accept_citas(base, row):
+    """Accept a CITAS *row* if its Chinese name matches the official name."""
+    if _match_names(base['name_zh'], row['N-hanzi']):
+        return None
+    return 'name %s (%s) does not match' % (row['N-hanzi'],
+                                            jianfan.ftoj(row['N-hanzi']))
+
+
+def _accept_gbt(base, row):
+    """Accept a GB/T 2260-2007 *row* unless it has a different name."""
+    if row['name_zh'] and row['name_zh'] != base['name_zh']:
+        return 'name %s does not match' % row['name_zh']
+    return None
+
+
+def _keyed(rows, key='code'):
+    """Yield (code, row) pairs from *rows*, for :func:`merge.join`."""
+    for row in rows:
+        yield int(row.pop(key)), row
+
+
+def _merge_gbt(main, sup):
+    """Merge rows from the two GB/T 2260-2007 files.
+
+    Values from the supplement *sup* are used, except for empty values and
+    name_zh, which are taken from *main*.
+    """
+    if main is None or sup is None:
+        return sup if main is None else main
+    result = dict(main)
+    for k, v in sup.items():
+        if k not in result or (k != 'name_zh' and v is not None):
+            result[k] = v
+    return result
+
+
+def iter_csv(db, schema=None, filter=None):
+    """Iterate over the rows of a CSV file data/*db*.csv.
+
+    Rows are read one at a time and yielded as :py:class:`dict`s. Fields named
+    in *schema* (default: :data:`SCHEMA`), a :py:class:`dict` mapping column
+    names to types, are converted: empty strings become :py:data:`None`, and
+    other values are passed to the type. Other fields are left as
+    :py:class:`str`. As with :py:class:`csv.DictReader`, fields missing from
+    short rows are :py:data:`None`, and extra fields in long rows are ignored.
+
+    If *filter* is a callable function, only CSV rows for which
+    ``filter(row) == True`` are returned. *filter* receives the row before
+    type conversion.
+    """
+    schema = SCHEMA if schema is None else schema
+
+    with open(data_fn(db), newline='', encoding='utf-8') as f:
+        reader = csv.reader(f)
+        header = next(reader)
+        width = len(header)
+        converters = [(i, name, schema[name]) for i, name in
+                      enumerate(header) if name in schema]
+
+        for values in reader:
+            if len(values) < width:
+                values.extend([None] * (width - len(values)))
+            row = dict(zip(header, values))
+
+            if callable(filter) and not filter(row):
+                continue
+
+            for i, name, type in converters:
+                value = values[i]
+                row[name] = type(value) if value else None
+
+            yield row
+
+
+def load_columns(db, schema=None, filter=None):
+    """Load a CSV file data/*db*.csv by columns.
+
+    A :py:class:`dict` is returned with keys that are column names, and values
+    that are :py:class:`list`s of column values, in file order. *schema* and
+    *filter* are as for :meth:`iter_csv`.
+    """
+    schema = SCHEMA if schema is None else schema
+
+    with open(data_fn(db), newline='', encoding='utf-8') as f:
+        reader = csv.reader(f)
+        header = next(reader)
+        width = len(header)
+        columns = [[] for _ in header]
+        types = [schema.get(name) for name in header]
+
+        for values in reader:
+            if len(values) < width:
+                values.extend([None] * (width - len(values)))
+            if callable(filter) and not filter(dict(zip(header, values))):
+                continue
+
+            for column, type, value in zip(columns, types, values):
+                if type is not None:
+                    value = type(value) if value else None
+                column.append(value)
+
+    return dict(zip(header, columns))
+
+
 def load_csv(db, key='code', keep_key=False, filter=None):
     """Load database from a CSV file data/*db*.csv.
 
     A :py:class:`dict` is returned with keys from an index on column *code*,
-    and values that are :py:class:`dict`s of database entries.
+    and values that are :py:class:`dict`s of database entries. Fields are
+    converted according to :data:`SCHEMA`; see :meth:`iter_csv`.
 
     If *keep_key* is :py:data:`True`, then the entries include *key*.
 
     If *filter* is a callable function, only CSV rows for which
     ``filter(row) == True`` are returned.
     """
-    fn = data_fn(db)
     result = {}
 
-    for row in csv.DictReader(open(fn)):
-        if callable(filter) and not filter(row):
-            continue
-
+    for row in iter_csv(db, filter=filter):
         code = int(row.pop(key))
 
         if keep_key:
             row[key] = code
 
-        try:
-            alpha = row.pop('alpha')
-            row['alpha'] = None if alpha == '' else alpha
-        except KeyError:
-            pass
-
-        for field, type in [('level', int),
-                            ('latitude', float),
-                            ('longitude', float)]:
-            try:
-                value = row.pop(field)
-                row[field] = type(value)
-            except KeyError:
-                pass
-            except ValueError as e:
-                assert value == ''
-                row[field] = None
-
         result[code] = row
 
     return result
@@ -232,7 +330,7 @@ def parse_html(f, year, method=2):
 
 
 def update(version='2015-09-30', use_cache=False, verbose=False,
-           target=None):
+           target=None, profile=False):
     """Update the database.
 
     :meth:`update` relies on four sources, in the following order of authority:
@@ -257,8 +355,18 @@ def update(version='2015-09-30', use_cache=False, verbose=False,
        <https://github.com/qiaolun>`_) and ``gbt_2260-2007_sup.csv``
        (supplement) transcribed from the published GB/T 2260-2007 standard.
 
+    The sources are joined on code in a single pass by :meth:`merge.merge`,
+    with the precedence of sources for each field given by
+    :data:`MERGE_FIELDS`. The number of values supplied by each source is
+    logged; with *verbose* output, the source of every field is also logged.
+
     If *verbose* is :py:data:`True`, verbose output is given.
 
+    If *profile* is :py:data:`True`, the wall time, CPU time, peak memory and
+    number of records of each stage of the update are measured, and returned
+    as a list of :py:class:`dict`s; see :meth:`.instrument.Profile.stage`.
+    Otherwise, :py:data:`None` is returned.
+
     The following files are updated:
 
     - ``latest.csv`` with information from source #1 only: codes, Chinese names
@@ -266,63 +374,71 @@ def update(version='2015-09-30', use_cache=False, verbose=False,
     - ``unified.csv`` with all database fields and information from sources #2,
       #3 and #4.
     - ``unified.db``, the same information in a :py:mod:`sqlite3` database.
+    - ``unified.arrow``, the same information in an Arrow IPC file, if
+      :py:mod:`pyarrow` is installed; see :meth:`write_arrow`.
     """
     _configure_log(verbose)
 
-    if use_cache:
-        try:
-            fn = data_fn(os.path.join('cache', version), 'html')
-            log.info('reading from cached %s', fn)
-            f = open(fn, 'r')
-        except FileNotFoundError:
-            log.info('  missing.')
-            use_cache = False
-
-    if not use_cache:
-        from urllib.request import urlopen
-        log.info('retrieving codes from %s', URLS[version])
-        f = urlopen(URLS[version])
+    prof = Profile(enabled=profile)
+
+    with prof.stage('fetch'):
+        if use_cache:
+            try:
+                fn = data_fn(os.path.join('cache', version), 'html')
+                log.info('reading from cached %s', fn)
+                with open(fn, 'r') as f:
+                    html = f.read()
+            except FileNotFoundError:
+                log.info('  missing.')
+                use_cache = False
+
+        if not use_cache:
+            from urllib.request import urlopen
+            log.info('retrieving codes from %s', URLS[version])
+            with urlopen(URLS[version]) as f:
+                html = f.read()
 
     # Parse the codes from HTML
-    log.info('  parsing...')
-    codes = parse_html(f, version.split('-')[0])
-    assert sorted(codes.keys()) == list(codes.keys())
-    log.info('  done.')
+    with prof.stage('parse_html') as stage:
+        log.info('  parsing...')
+        codes = parse_html(html, version.split('-')[0])
+        assert sorted(codes.keys()) == list(codes.keys())
+        log.info('  done.')
+        stage['records'] = len(codes)
 
     # Save the latest table
-    fn = data_fn('latest', path=target)
-    with open(fn, 'w') as f1:
-        w = csv.writer(f1, lineterminator=linesep)
-        w.writerow(['code', 'name_zh', 'level'])
-        for code in sorted(codes.keys()):
-            w.writerow([code, codes[code]['name_zh'], codes[code]['level']])
-    log.info('wrote %s', fn)
+    with prof.stage('write latest') as stage:
+        fn = data_fn('latest', path=target)
+        with open(fn, 'w') as f1:
+            w = csv.writer(f1, lineterminator=linesep)
+            w.writerow(['code', 'name_zh', 'level'])
+            for code in sorted(codes.keys()):
+                w.writerow([code, codes[code]['name_zh'],
+                            codes[code]['level']])
+        log.info('wrote %s', fn)
+        stage['records'] = len(codes)
 
     # Load the CITAS table
-    d1 = load_csv('citas', 'C-gbcode',
-                  filter=lambda row: row['todate'] == '19941231')
-    log.info('read CITAS data')
+    with prof.stage('load_csv citas') as stage:
+        citas = list(_keyed(iter_csv(
+            'citas', filter=lambda row: row['todate'] == '19941231'),
+            'C-gbcode'))
+        log.info('read CITAS data')
+        stage['records'] = len(citas)
 
     # Load the GB/T 2260-2007 tables, from two files
-    d2 = load_csv('gbt_2260-2007')
-    d3 = load_csv('gbt_2260-2007_sup')
-    log.info('loaded GB/T 2260-2007 entries')
-
-    # Merge the two GB/T 2260-2007 files
-    for code, d in d3.items():
-        if code in d2:
-            # Code appears in both files. Don't overwrite name_zh in
-            # gbt_2260-2007.csv with an empty name_zh from
-            # gbt_2260-2007_sup.csv.
-            _dict_update(d2[code], d, conflict=lambda a, b, k: not(k ==
-                         'name_zh' or b is None))
-        else:
-            # Code only appears in gbt_2260-2007_sup.csv
-            d2[code] = d
+    with prof.stage('load_csv gbt_2260-2007') as stage:
+        gbt = [(code, _merge_gbt(*rows)) for code, rows in
+               join(_keyed(iter_csv('gbt_2260-2007')),
+                    _keyed(iter_csv('gbt_2260-2007_sup')))]
+        log.info('loaded GB/T 2260-2007 entries')
+        stage['records'] = len(gbt)
 
     # Load extra data pertaining to the latest table
-    d4 = load_csv('extra')
-    log.info('loaded extra data')
+    with prof.stage('load_csv extra') as stage:
+        extra = list(_keyed(iter_csv('extra')))
+        log.info('loaded extra data')
+        stage['records'] = len(extra)
 
     # Regular expression for English names from the CITAS database:
     # In a name like 'Beijing: Dongcheng qu' the prefix 'Beijing: ' is a
@@ -330,115 +446,219 @@ def update(version='2015-09-30', use_cache=False, verbose=False,
     # the type, not the name, of the area.
     name_re = re.compile('(?:[^:]*: )?(.*?)(?: (%s))?$' % '|'.join(SUFFIXES))
 
-    pinyin = Pinyin()
-
     # Merge using codes
-    log.info('merging codes')
-    for code, entry in codes.items():
-        # Store debug information to be printed (or not) later
-        message = ['%s\t%s' % (code, entry['name_zh'])]
-
-        if code in d1:
-            # Merge CITAS entry for this code
-            # Make a copy
-            d = dict(d1[code])
-            name_zh = d.pop('N-hanzi')
-            if not _match_names(entry['name_zh'], name_zh):
-                message.append('  CITAS name %s (%s) does not match' %
-                               (name_zh, jianfan.ftoj(name_zh)))
-            else:
-                d['name_en'] = d.pop('N-local').replace("`", "'")
-                d['name_pinyin'] = d.pop('N-pinyin').replace("`", "'")
-                _dict_update(entry, d)
-        else:
-            message.append('  does not appear in CITAS data set')
-
-        if code in d2:
-            # Merge GB/T 2260-2007 entry for this code
-            d = dict(d2[code])
-            if len(d['name_zh']) and entry['name_zh'] != d['name_zh']:
-                message.append('  GB/T 2260-2007 name %s does not match' %
-                               d['name_zh'])
-            else:
-                # Don't overwrite name_en from CITAS with empty name_en from
-                # GB/T 2260-2007
-                _dict_update(entry, d, conflict=lambda a, b, k: not(
-                             'name_' in k and b is ''))
-        else:
-            message.append('  does not appear in GB/T 2260-2007')
-
-        # Merge extra data
-        if code in d4:
-            _dict_update(entry, d4[code], conflict='squash')
-
-        # Clean up English names (in most cases, the CITAS romanized name)
-        if entry['name_en'] is not None:
-            # Replace ' shixiaqu' with ' city area', but do not discard
-            name_en = entry['name_en'].replace(' shixiaqu', ' city area')
-            # Use regex to discard prefixes and suffixes on names
-            entry['name_en'] = name_re.match(name_en).group(1)
-        elif entry['name_zh'] == '市辖区':
-            # Fill in blank with 'CITYNAME city area', where possible
-            pname = codes[_parents(code)[1]]['name_en']
-            entry['name_en'] = None if pname is None else pname + ' city area'
-
-        # Fill in pinyin names
-        if entry['name_pinyin'] is None:
-            entry['name_pinyin'] = pinyin.get_pinyin(entry['name_zh'],
-                                                     '').title()
-
-        if len(message) > 1 and 'does not appear in CITAS' not in message[1]:
-            log.info('\n'.join(message))
-        else:
-            log.debug('\n'.join(message))
-    log.info('merge complete')
+    merged = {}
+    sources = {}
+
+    with prof.stage('merge') as stage:
+        log.info('merging codes')
+        for entry, provenance, notes in merge(
+                Source('nbs', codes.items()), [
+                    Source('citas', citas, fields=_CITAS_FIELDS,
+                           accept=_accept_citas),
+                    Source('gbt', gbt, accept=_accept_gbt),
+                    Source('extra', extra),
+                    ], MERGE_FIELDS):
+            code = entry['code']
+            merged[code] = entry
+            sources[code] = provenance
+
+            # Clean up English names (in most cases, the CITAS romanized name)
+            if entry['name_en'] is not None:
+                # Replace ' shixiaqu' with ' city area', but do not discard
+                name_en = entry['name_en'].replace(' shixiaqu', ' city area')
+                # Use regex to discard prefixes and suffixes on names
+                entry['name_en'] = name_re.match(name_en).group(1)
+            elif entry['name_zh'] == '市辖区':
+                # Fill in blank with 'CITYNAME city area', where possible
+                pname = merged[_parents(code)[1]]['name_en']
+                if pname is not None:
+                    entry['name_en'] = pname + ' city area'
+                    provenance['name_en'] = 'parent'
+
+            # Sources that were rejected are reported; those that are missing
+            # only with verbose output
+            for source, reason in notes:
+                log.log(logging.DEBUG if reason == 'missing' else logging.INFO,
+                        '%d\t%s\t%s: %s', code, entry['name_zh'], source,
+                        reason)
+        log.info('merge complete')
+        stage['records'] = len(merged)
+
+    # Fill in pinyin names
+    with prof.stage('pinyin') as stage:
+        pinyin = Pinyin()
+        filled = 0
+        for code, entry in merged.items():
+            if entry['name_pinyin'] is None:
+                entry['name_pinyin'] = pinyin.get_pinyin(entry['name_zh'],
+                                                         '').title()
+                sources[code]['name_pinyin'] = 'xpinyin'
+                filled += 1
+        stage['records'] = filled
+
+    # Report the sources of each field
+    suppliers = Counter()
+    for code, provenance in sources.items():
+        suppliers.update(provenance.items())
+        log.debug('%d\tsources: %s', code, ', '.join(
+            '%s=%s' % item for item in sorted(provenance.items())))
+    for field in MERGE_FIELDS:
+        log.info('  %s: %s', field, ', '.join(
+            '%s %d' % (source, n) for (f, source), n in
+            sorted(suppliers.items()) if f == field))
 
     # Write the unified data set to CSV
-    fn = data_fn('unified', path=target)
-    with open(fn, 'w') as f:
-        w = csv.DictWriter(f, ('code', 'name_zh', 'name_en', 'name_pinyin',
-                               'alpha', 'level', 'latitude', 'longitude'),
-                           extrasaction='ignore', lineterminator=linesep)
-        w.writeheader()
-        for k in sorted(codes.keys()):
-            w.writerow(codes[k])
-    log.info('wrote %s', fn)
-
-    write_sqlite('unified', codes, target=target)
-    log.info('wrote sqlite3 database')
-
-
-def write_sqlite(db, data, target=None):
-    """Write *data* to a table codes in data/*db*.db."""
-
-    # Connect to database
-    conn = sqlite3.connect(data_fn(db, 'db', path=target))
-    cur = conn.cursor()
-
-    # Create the table
-    cur.execute('DROP TABLE IF EXISTS codes')
-    cur.execute("""CREATE TABLE codes (
-        code        int   PRIMARY KEY,
-        name_zh     text  NOT NULL,
-        level       int   NOT NULL,
-        name_pinyin text,
-        name_en     text,
-        alpha       text,
-        latitude    real,
-        longitude   real)
-        """)
-
-    # Query string
-    insert_query = 'INSERT INTO codes (' + ', '.join(COLUMNS) + ') VALUES (:'
-    insert_query += ', :'.join(COLUMNS) + ')'
-
-    # Insert data
-    cur.executemany(insert_query, data.values())
-
-    # Commit & close
-    cur.close()
-    conn.commit()
-    conn.close()
+    with prof.stage('write unified') as stage:
+        fn = data_fn('unified', path=target)
+        with open(fn, 'w') as f:
+            w = csv.DictWriter(f, ('code', 'name_zh', 'name_en',
+                                   'name_pinyin', 'alpha', 'level',
+                                   'latitude', 'longitude'),
+                               extrasaction='ignore', lineterminator=linesep)
+            w.writeheader()
+            for k in sorted(merged.keys()):
+                w.writerow(merged[k])
+        log.info('wrote %s', fn)
+        stage['records'] = len(merged)
+
+    with prof.stage('write_sqlite') as stage:
+        write_sqlite('unified', merged, target=target)
+        log.info('wrote sqlite3 database')
+        stage['records'] = len(merged)
+
+    with prof.stage('write_arrow') as stage:
+        try:
+            write_arrow('unified', merged, target=target)
+        except ImportError:
+            log.info('pyarrow is not installed; skipped Arrow file')
+        else:
+            log.info('wrote Arrow file')
+            stage['records'] = len(merged)
+
+    return prof.stages if profile else None
+
+
+def _data_version(rows):
+    """Return a checksum of *rows*, a sequence of database entries."""
+    version = 0
+    for row in rows:
+        version = crc32(repr([row[c] for c in COLUMNS]).encode('utf-8'),
+                        version)
+    # A positive, 31-bit value, for PRAGMA user_version
+    return version & 0x7fffffff
+
+
+def write_sqlite(db, data, target=None, page_size=4096):
+    """Write *data* to a table codes in data/*db*.db.
+
+    *data* is either a :py:class:`dict` with values that are :py:class:`dict`s
+    of database entries, as returned by :meth:`load_csv`, or an iterable of
+    such entries, as returned by :meth:`iter_csv`.
+
+    The database is built as a bulk load: rows are written, sorted by code,
+    into a temporary file in the same directory with journaling and syncing
+    disabled. Secondary indexes are created after all rows are loaded, and
+    ``ANALYZE`` is run so the query planner can use them. Only then is the
+    finished file moved into place, so readers never see a partial database.
+
+    A checksum of the data is stored as ``PRAGMA user_version``; this is the
+    :attr:`.Database.version` of the database.
+    """
+    db_fn = data_fn(db, 'db', path=target)
+    tmp_fn = _temp_file(db_fn, '.%s-' % db)
+
+    try:
+        # Connect to the temporary database
+        conn = sqlite3.connect(tmp_fn, isolation_level=None)
+        try:
+            cur = conn.cursor()
+
+            # Fast-load settings. page_size must be set before the first
+            # table is created.
+            cur.execute('PRAGMA page_size = %d' % page_size)
+            for pragma in _BULK_PRAGMAS:
+                cur.execute('PRAGMA %s' % pragma)
+
+            cur.execute('BEGIN')
+
+            # Create the table. An INTEGER PRIMARY KEY is an alias for the
+            # rowid, so rows inserted in code order are appended to the
+            # b-tree.
+            cur.execute("""CREATE TABLE codes (
+                code        INTEGER PRIMARY KEY,
+                name_zh     text  NOT NULL,
+                level       int   NOT NULL,
+                name_pinyin text,
+                name_en     text,
+                alpha       text,
+                latitude    real,
+                longitude   real)
+                """)
+
+            # Query string
+            insert_query = 'INSERT INTO codes (' + ', '.join(COLUMNS) + \
+                ') VALUES (:' + ', :'.join(COLUMNS) + ')'
+
+            # Insert data, sorted by primary key
+            if isinstance(data, dict):
+                data = data.values()
+            data = sorted(data, key=itemgetter('code'))
+            cur.executemany(insert_query, data)
+
+            # Build secondary indexes over the loaded data
+            for column in _INDEXED_COLUMNS:
+                cur.execute('CREATE INDEX codes_%s ON codes (%s)' %
+                            (column, column))
+
+            cur.execute('PRAGMA user_version = %d' % _data_version(data))
+            cur.execute('COMMIT')
+            cur.execute('ANALYZE')
+            cur.close()
+        finally:
+            conn.close()
+
+        # Atomically swap in the finished database
+        os.replace(tmp_fn, db_fn)
+    except BaseException:
+        os.remove(tmp_fn)
+        raise
+
+
+def write_arrow(db, data, target=None, version=None):
+    """Write *data* to an Arrow IPC (Feather version 2) file data/*db*.arrow.
+
+    *data* is as for :meth:`write_sqlite`. The file contains the columns of
+    the database and hierarchy keys; see :meth:`.Database.to_arrow`. It can
+    be read by e.g. :py:mod:`pyarrow`, DuckDB or Polars. *version* is stored
+    in the file metadata; by default, it is the same checksum of the data
+    stored by :meth:`write_sqlite`.
+
+    Requires :py:mod:`pyarrow`; if it is not installed, raises
+    :py:class:`ImportError`. As for :meth:`write_sqlite`, the file is written
+    to a temporary file, then moved into place.
+    """
+    import pyarrow as pa
+
+    if isinstance(data, dict):
+        data = data.values()
+    data = sorted(data, key=itemgetter('code'))
+    if version is None:
+        version = _data_version(data)
+    table = _arrow_table({c: [row[c] for row in data] for c in COLUMNS},
+                         version)
+
+    fn = data_fn(db, 'arrow', path=target)
+    tmp_fn = _temp_file(fn, '.%s-' % db)
+
+    try:
+        with pa.OSFile(tmp_fn, 'wb') as sink:
+            with pa.ipc.new_file(sink, table.schema) as writer:
+                writer.write_table(table)
+        os.replace(tmp_fn, fn)
+    except BaseException:
+        os.remove(tmp_fn)
+        raise
 
 
 def refresh_cache(target=None):
@@ -0,0 +1,161 @@
+"""Access to the database from :py:mod:`asyncio` code, for instance::
+
+    async def handler(request):
+        div = await db.search(name_zh=request.query['name'])
+        ...
+
+    db = AsyncDatabase()
+"""
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+from .code import _coerce, _parents
+from .database import Database
+
+__all__ = [
+    'AsyncDatabase',
+    ]
+
+try:
+    _running_loop = asyncio.get_running_loop
+except AttributeError:  # Python < 3.7
+    _running_loop = asyncio.get_event_loop
+
+
+class AsyncDatabase:
+    """Awaitable version of :class:`.Database`.
+
+    Methods have the same arguments and results as those of
+    :class:`.Database`, but are coroutines. Queries that need to read from
+    the database file run on a dedicated thread, so the event loop is never
+    blocked by I/O; results that are already in memory (divisions that have
+    been loaded before, :meth:`lookup`, and cached results of :meth:`search`)
+    are returned directly, without a switch to the thread.
+
+    *db* is either an existing :class:`.Database`, e.g.
+    :data:`gb2260.divisions`, or the name of a database to open. In the latter
+    case, other arguments, e.g. *cache_size*, are passed to
+    :class:`.Database`.
+    """
+
+    def __init__(self, db='unified', **kwargs):
+        # Queries on a sqlite3 connection are serialized, so a single thread
+        # is used
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self.db = db if isinstance(db, Database) else Database(db, **kwargs)
+
+    async def run(self, f, *args, **kwargs):
+        """Call ``f(*args, **kwargs)`` on the thread used for queries.
+
+        Use this for other blocking functions that query the database, e.g.
+        :meth:`gb2260.parent`.
+        """
+        loop = _running_loop()
+        return await loop.run_in_executor(self._executor,
+                                          partial(f, *args, **kwargs))
+
+    async def _many(self, f, items, return_exceptions):
+        """Call *f* on each of *items* in a single switch to the thread."""
+        def call_all():
+            result = []
+            for item in items:
+                try:
+                    result.append(f(item))
+                except LookupError as e:
+                    if not return_exceptions:
+                        raise
+                    result.append(e)
+            return result
+
+        return await self.run(call_all)
+
+    def _in_memory(self, code):
+        """Return the division for *code*, or None if it is not loaded."""
+        try:
+            return self.db._index.get(_coerce(code))
+        except (TypeError, ValueError):
+            return None
+
+    async def get(self, code=None, **kwarg):
+        if code is not None and len(kwarg) == 0:
+            result = self._in_memory(code)
+            if result is not None:
+                return result
+        return await self.run(self.db.get, code, **kwarg)
+
+    async def lookup(self, value, strict=False):
+        if self.db._is_loaded:
+            # Lookups use an in-memory index
+            return self.db.lookup(value, strict)
+        return await self.run(self.db.lookup, value, strict)
+
+    async def search(self, **kwargs):
+        try:
+            return self.db._peek('search', **kwargs)
+        except KeyError as e:
+            if type(e) is not KeyError:
+                # A cached RegionKeyError
+                raise
+        return await self.run(self.db.search, **kwargs)
+
+    async def search_ranked(self, k=5, context=None, **kwargs):
+        if self.db._is_loaded:
+            # Ranked searches use in-memory indexes
+            return self.db.search_ranked(k, context, **kwargs)
+        return await self.run(self.db.search_ranked, k, context, **kwargs)
+
+    async def stack(self, code):
+        result = [self._in_memory(c) for c in sorted(set(_parents(
+            _coerce(code))))]
+        if all(div is not None for div in result):
+            return tuple(result)
+        return await self.run(self.db.stack, code)
+
+    async def get_many(self, codes, return_exceptions=False):
+        """Return a list of divisions for each of *codes*.
+
+        If *return_exceptions* is :py:data:`True`, then for invalid codes the
+        exception (e.g. :class:`.InvalidCodeError`) is included in the list.
+        Otherwise, the first exception is raised.
+        """
+        codes = list(codes)
+        result = [self._in_memory(code) for code in codes]
+        missing = [code for code, div in zip(codes, result) if div is None]
+
+        if len(missing):
+            found = iter(await self._many(self.db.get, missing,
+                                          return_exceptions))
+            result = [next(found) if div is None else div for div in result]
+
+        return result
+
+    async def lookup_many(self, values):
+        """Return a list of the results of :meth:`lookup` for *values*.
+
+        As for :meth:`.Database.lookup_many`, where a value matches no
+        division, the list contains :py:data:`None`.
+        """
+        if self.db._is_loaded:
+            # Lookups use an in-memory index
+            return self.db.lookup_many(values)
+        return await self.run(self.db.lookup_many, values)
+
+    async def search_many(self, queries, return_exceptions=False):
+        """Return a list of the results of :meth:`search` for *queries*.
+
+        Each of *queries* is a :py:class:`dict` of keyword arguments to
+        :meth:`search`. *return_exceptions* is as for :meth:`get_many`.
+        """
+        return await self._many(lambda kw: self.db.search(**kw), queries,
+                                return_exceptions)
+
+    def close(self):
+        """Stop the thread used for queries."""
+        self._executor.shutdown(wait=True)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self.close()
@@ -0,0 +1,74 @@
+from collections import OrderedDict, namedtuple
+from threading import Lock
+from time import monotonic
+
+#: Statistics for a :class:`LRUCache`, as returned by :meth:`LRUCache.info`.
+CacheInfo = namedtuple('CacheInfo', [
+    'hits',
+    'misses',
+    'evictions',
+    'maxsize',
+    'currsize',
+    ])
+
+
+class LRUCache:
+    """A bounded mapping that discards the least recently used items.
+
+    At most *maxsize* items are kept. If *ttl* is given, items expire that
+    many seconds after they were stored. Lookups with ``cache[key]`` count
+    hits and misses; a missing or expired key raises :py:class:`KeyError`.
+    The cache may be used from several threads.
+    """
+
+    def __init__(self, maxsize=1024, ttl=None):
+        if maxsize < 1:
+            raise ValueError('maxsize must be at least 1')
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = Lock()
+        self.hits = self.misses = self.evictions = 0
+
+    def __getitem__(self, key):
+        try:
+            return self.peek(key)
+        except KeyError:
+            self.misses += 1
+            raise
+
+    def __setitem__(self, key, value):
+        expires = None if self.ttl is None else monotonic() + self.ttl
+        with self._lock:
+            self._data[key] = (value, expires)
+            self._data.move_to_end(key)
+
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def peek(self, key):
+        """Like ``cache[key]``, but a missing key is not counted as a miss."""
+        with self._lock:
+            value, expires = self._data[key]
+
+            if expires is not None and expires < monotonic():
+                del self._data[key]
+                raise KeyError(key)
+
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def __len__(self):
+        return len(self._data)
+
+    def clear(self):
+        """Discard all items. Statistics are retained."""
+        with self._lock:
+            self._data.clear()
+
+    def info(self):
+        """Return a :data:`CacheInfo` with statistics."""
+        return CacheInfo(self.hits, self.misses, self.evictions, self.maxsize,
+                         len(self._data))
@@ -1,10 +1,32 @@
+from array import array
+from bisect import bisect_left
+from collections import Counter, OrderedDict, defaultdict, namedtuple
+from functools import wraps
+from itertools import islice
 import logging
+from math import asin, cos, degrees, floor, radians, sin, sqrt
 import os.path
 import sqlite3
+import tempfile
+from threading import Lock
+from time import perf_counter
+from weakref import WeakValueDictionary
 
 from pkg_resources import resource_filename
 
-from .code import _coerce, _join, _level, _parents, split
+from .cache import LRUCache
+from .code import _coerce, _level, _parents
+from .instrument import Instrumentation
+from .names import (  # noqa: F401
+    SHORT_FORMS,
+    SUFFIXES,
+    roman_key,
+    short_roman,
+    short_zh,
+    simplified,
+    traditional,
+    traditional_forms,
+    )
 
 log = logging.getLogger(__name__)
 
@@ -19,18 +41,65 @@ COLUMNS = [
     'longitude',
     ]
 
-DATA_DIR = resource_filename(__name__, 'data')
-
-SUFFIXES = [
-    'kuangqu',    # 矿区, mining area
-    'qi',         # 旗, banner
-    'qu',         # 区, area
-    'shi',        # 市, city
-    'xian',       # 县, county
-    'zizhixian',  # 自治县, autonomous county
-    'zizhizhou',  # 自治州, autonomous state
+#: Number of possible six-digit codes.
+CODE_SPACE = 1000000
+
+#: Python types of the database fields.
+FIELD_TYPES = OrderedDict([
+    ('code', int),
+    ('name_zh', str),
+    ('level', int),
+    ('name_pinyin', str),
+    ('name_en', str),
+    ('alpha', str),
+    ('latitude', float),
+    ('longitude', float),
+    ])
+
+#: Columns with the codes of the divisions containing each division, in the
+#: table returned by :meth:`Database.to_arrow`: the division at level 1, and
+#: the division at level 2 (null for divisions at level 1). A division at
+#: either level contains itself.
+HIERARCHY_COLUMNS = [
+    'province_code',
+    'prefecture_code',
     ]
 
+#: Size, in degrees, of the cells of the grid used by :meth:`Database.in_bbox`
+#: and :meth:`Database.within_radius`.
+GRID_SIZE = 1.0
+
+#: Mean radius of the Earth, in kilometres.
+EARTH_RADIUS = 6371.0088
+
+#: Statistics computed by :meth:`Database.rollup`.
+ROLLUP_STATS = ('count', 'sum', 'mean', 'min', 'max')
+
+#: Result of :meth:`Database.rollup`.
+Rollup = namedtuple('Rollup', ['aggregates', 'unmatched'])
+
+#: Result of :meth:`Database.distances`.
+DistanceMatrix = namedtuple('DistanceMatrix', ['codes', 'distances'])
+
+#: Element of the result of :meth:`Database.search_ranked`.
+Candidate = namedtuple('Candidate', ['score', 'division', 'match'])
+
+#: Weights of the parts of the score in :meth:`Database.search_ranked`: for
+#: an exact match or a match on the short form of the name, and for each of
+#: the hints in the *context*.
+RANK_WEIGHTS = {
+    'exact': 1.0,
+    'short': 0.8,
+    'within': 1.0,
+    'near': 1.0,
+    'level': 0.5,
+    }
+
+#: Distance in km at which the score for the 'near' hint is halved.
+RANK_DISTANCE = 100.0
+
+DATA_DIR = resource_filename(__name__, 'data')
+
 
 class AmbiguousRegionError(LookupError):
     """Exception for a lookup that returns multiple results."""
@@ -48,6 +117,7 @@ class RegionKeyError(KeyError):
 
 
 def lazy_load(f):
+    @wraps(f)
     def load_if_needed(self, *args, **kw):
         if not self._is_loaded:
             self._load()
@@ -55,9 +125,328 @@ def lazy_load(f):
     return load_if_needed
 
 
+def instrumented(f):
+    """Decorator for Database methods that are counted and timed.
+
+    When instrumentation is disabled, the only overhead is one attribute
+    check.
+    """
+    name = f.__name__
+
+    @wraps(f)
+    def wrapper(self, *args, **kwargs):
+        if self._instrument is None:
+            return f(self, *args, **kwargs)
+        return self._instrument.call(name, f, (self,) + args, kwargs)
+    return wrapper
+
+
+class _Raise:
+    """A cached exception; see :func:`cached`."""
+
+    def __init__(self, exc):
+        self.cls = exc.__class__
+        self.args = exc.args
+
+
+# Functions giving cache keys for the arguments of cached Database methods
+_cache_keys = {}
+
+
+def cached(key):
+    """Decorator for Database methods with results stored in the query cache.
+
+    *key* is called with the arguments of the method, and returns a tuple of
+    hashable values that identify the query. If the method raises
+    :py:class:`LookupError` (i.e. no or ambiguous results), this is also
+    cached, and raised again on later calls.
+    """
+    def decorator(f):
+        _cache_keys[f.__name__] = key
+
+        @wraps(f)
+        def wrapper(self, *args, **kwargs):
+            cache = self._cache
+            if cache is None:
+                return f(self, *args, **kwargs)
+
+            try:
+                k = (f.__name__,) + key(*args, **kwargs)
+                result = cache[k]
+            except (TypeError, ValueError):
+                # Unhashable or invalid arguments
+                return f(self, *args, **kwargs)
+            except KeyError:
+                try:
+                    result = f(self, *args, **kwargs)
+                except LookupError as e:
+                    cache[k] = _Raise(e)
+                    raise
+                cache[k] = result
+                return result
+
+            if isinstance(result, _Raise):
+                raise result.cls(*result.args)
+            return result
+        return wrapper
+    return decorator
+
+
+def _value_keys(value):
+    """Return keys for *value* in the map built by :func:`_value_map`."""
+    keys = []
+    for ftype in (int, str, float):
+        try:
+            v = ftype(value)
+        except (TypeError, ValueError):
+            continue
+        # Include the type, since e.g. 1 == 1.0, but only one is a valid code
+        keys.append((ftype, v.lower() if ftype is str else v))
+    return keys
+
+
+def _value_map(divisions):
+    """Map every value in *divisions* to a division, for Database.lookup().
+
+    Returns a :py:class:`dict` with keys from :func:`_value_keys` and values
+    (priority, division), where priority is the index of the matched field in
+    :data:`COLUMNS`; and a set of keys that match more than one division.
+    """
+    values = {}
+    ambiguous = set()
+    for priority, (field, ftype) in enumerate(FIELD_TYPES.items()):
+        for div in divisions:
+            v = div[field]
+            if v is None:
+                continue
+            key = (ftype, v.lower() if ftype is str else v)
+            existing = values.setdefault(key, (priority, div))
+            if existing[1] is not div:
+                ambiguous.add(key)
+    return values, ambiguous
+
+
+def _search_key(**kwargs):
+    if kwargs.get('within') is not None:
+        kwargs['within'] = _coerce(kwargs['within'])
+    kwargs['partial'] = bool(kwargs.get('partial', False))
+    kwargs['short'] = bool(kwargs.get('short', False))
+    return tuple(sorted((k, v) for k, v in kwargs.items() if v is not None))
+
+
+def _bitmap(codes):
+    """Return a bitmap of *codes*: bit (code % 8) of byte (code // 8) is set.
+    """
+    bits = bytearray(CODE_SPACE // 8)
+    for code in codes:
+        bits[code >> 3] |= 1 << (code & 7)
+    return bits
+
+
+def _offsets(codes):
+    """Return a direct-address table of the row offsets of *codes*.
+
+    Element *code* of the table is the position of *code* in *codes*, or -1.
+    """
+    codes = list(codes)
+    table = array('h' if len(codes) <= 0x7fff else 'i', [-1]) * CODE_SPACE
+    for i, code in enumerate(codes):
+        table[code] = i
+    return table
+
+
+def _arrow_table(columns, version):
+    """Return a :class:`pyarrow.Table` of *columns*.
+
+    *columns* maps each field in :data:`COLUMNS` to a list of values, in code
+    order. *version* is stored in the schema metadata.
+    """
+    import pyarrow as pa
+
+    types = {int: pa.int32(), str: pa.string(), float: pa.float64()}
+    fields = [pa.field(f, types[t]) for f, t in FIELD_TYPES.items()]
+    arrays = [pa.array(columns[f], type=field.type) for f, field in
+              zip(FIELD_TYPES, fields)]
+
+    # Hierarchy keys
+    codes = set(columns['code'])
+    province = [c - c % 10000 for c in columns['code']]
+    prefecture = [None if l < 2 else c - c % 100 for c, l in
+                  zip(columns['code'], columns['level'])]
+    for name, values in zip(HIERARCHY_COLUMNS, (province, prefecture)):
+        fields.append(pa.field(name, pa.int32()))
+        arrays.append(pa.array([c if c in codes else None for c in values],
+                               type=pa.int32()))
+
+    schema = pa.schema(fields, metadata={'version': str(version)})
+    return pa.Table.from_arrays(arrays, schema=schema)
+
+
+def _span(code):
+    """Return the width of the range of codes within *code*."""
+    return 10000 if code % 10000 == 0 else 100 if code % 100 == 0 else 1
+
+
+def _haversine(lat1, lon1, lat2, lon2):
+    """Return the great-circle distance in km between two points."""
+    lat1, lon1, lat2, lon2 = map(radians, (lat1, lon1, lat2, lon2))
+    a = sin((lat2 - lat1) / 2) ** 2 + \
+        cos(lat1) * cos(lat2) * sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS * asin(min(1, sqrt(a)))
+
+
+def _haversine_block(np, lat1, lon1, lat2, lon2):
+    """Return the matrix of distances in km between two sets of points.
+
+    Coordinates are NumPy arrays in radians. Element (i, j) of the result is
+    the distance from point i of the first set to point j of the second.
+    """
+    a = np.sin((lat2[np.newaxis, :] - lat1[:, np.newaxis]) / 2) ** 2 + \
+        np.cos(lat1)[:, np.newaxis] * np.cos(lat2)[np.newaxis, :] * \
+        np.sin((lon2[np.newaxis, :] - lon1[:, np.newaxis]) / 2) ** 2
+    return 2 * EARTH_RADIUS * np.arcsin(np.sqrt(np.minimum(a, 1)))
+
+
+def _grid(columns):
+    """Return a grid of the row offsets of divisions, by coordinates.
+
+    The result maps ``(row, column)`` of cells of :data:`GRID_SIZE` degrees
+    to lists of offsets. Divisions without coordinates are omitted.
+    """
+    grid = defaultdict(list)
+    for i, (lat, lon) in enumerate(zip(columns['latitude'],
+                                       columns['longitude'])):
+        if lat is None or lon is None:
+            continue
+        grid[(floor(lat / GRID_SIZE), floor(lon / GRID_SIZE))].append(i)
+    return dict(grid)
+
+
+def _summary(columns):
+    """Compute summary statistics of *columns*, for Database.summary()."""
+    codes = columns['code']
+
+    # Number of children of each division, using the parent() semantics
+    children = dict.fromkeys(codes, 0)
+    for code, level in zip(codes, columns['level']):
+        if level > 1:
+            parent = code - code % (10000 if level == 2 else 100)
+            if parent in children:
+                children[parent] += 1
+
+    return dict(
+        count=len(codes),
+        levels=dict(sorted(Counter(columns['level']).items())),
+        children=children,
+        coverage={f: sum(v is not None and v != '' for v in columns[f]) for
+                  f in COLUMNS},
+        )
+
+
+def _rollup_stats(stats, count, total, low, high):
+    """Return a :py:class:`dict` of *stats* for Database.rollup()."""
+    result = dict(count=count, sum=total, mean=total / count, min=low,
+                  max=high)
+    return {stat: result[stat] for stat in stats}
+
+
+def _short_map(columns):
+    """Map the short forms of names to row offsets, for Database.search().
+
+    Returns a :py:class:`dict` with a :py:class:`dict` for each field in
+    :data:`.names.SHORT_FORMS`, mapping short forms to lists of offsets.
+    """
+    result = {}
+    for field, short in SHORT_FORMS.items():
+        index = result[field] = defaultdict(list)
+        for i, name in enumerate(columns[field]):
+            if name:
+                index[short(name)].append(i)
+        result[field] = dict(index)
+    return result
+
+
+#: Fields with romanized names, searched using normalized forms.
+ROMAN_FIELDS = ('name_pinyin', 'name_en')
+
+
+def _roman_map(columns):
+    """Map normalized romanized names to row offsets, for Database.search().
+
+    Returns a :py:class:`dict` with a :py:class:`dict` for each field in
+    :data:`ROMAN_FIELDS`, mapping the results of :func:`.names.roman_key` to
+    lists of offsets.
+    """
+    result = {}
+    for field in ROMAN_FIELDS:
+        index = defaultdict(list)
+        for i, name in enumerate(columns[field]):
+            if name:
+                index[roman_key(name)].append(i)
+        result[field] = dict(index)
+    return result
+
+
+def _read_arrow(fn):
+    """Read the Arrow IPC file *fn*, memory-mapped."""
+    import pyarrow as pa
+
+    with pa.memory_map(fn) as source:
+        return pa.ipc.open_file(source).read_all()
+
+
+def _is_numpy(obj):
+    """Return True if *obj* is a NumPy array, without importing NumPy."""
+    return type(obj).__module__ == 'numpy' and hasattr(obj, '__array__')
+
+
+def _isolike_map(index):
+    """Compute ISO 3166-2-like codes for divisions in *index*.
+
+    Returns a :py:class:`dict` mapping codes to codes without prefix, e.g.
+    'HE-SJW' (or :py:data:`None`, if any division in the stack has no alpha
+    code); and the reverse mapping. Codes with a missing parent are omitted.
+    """
+    forward = {}
+    reverse = {}
+    for code in sorted(index):
+        stack = [index.get(c) for c in sorted(set(_parents(code)))]
+        if any(div is None for div in stack):
+            continue
+        parts = [div.alpha for div in stack]
+        if None in parts:
+            forward[code] = None
+        else:
+            forward[code] = '-'.join(parts)
+            reverse.setdefault(forward[code], code)
+    return forward, reverse
+
+
+# Open databases, by name, used to unpickle divisions
+_databases = WeakValueDictionary()
+
+
+def _intern(name, code, version):
+    """Return the division with *code* from database *name*.
+
+    Used to unpickle a :class:`Division`. Raises :py:class:`ValueError` if
+    the database does not have data version *version*.
+    """
+    db = _databases.get(name)
+    if db is None:
+        db = Database(name)
+    if db.version != version:
+        raise ValueError('division %d is from version %d of database %r, '
+                         'not %d' % (code, version, name, db.version))
+    return db._get_by_code(code)
+
+
 class Division:
     _getattr_levels = ['is_province', 'is_prefecture', 'is_county']
 
+    # The Database that created this division
+    _db = None
+
     def __init__(self, cur=None, row=None, **fields):
         if cur:
             row = sqlite3.Row(cur, row)
@@ -77,7 +466,10 @@ class Division:
         return self._row[key]
 
     def __eq__(self, other):
-        if hasattr(other, '_row'):
+        if self is other:
+            return True
+        elif hasattr(other, '_row'):
+            # A division from another Database
             return self._row == other._row
         else:
             other = _coerce(other)
@@ -98,43 +490,560 @@ class Division:
     def __dir__(self):
         return dir(self.__class__) + self._row.keys()
 
+    def __reduce__(self):
+        # Pickle only the code; the division is looked up again on unpickling
+        if self._db is None:
+            raise TypeError('cannot pickle a division without a database')
+        return _intern, (self._db.name, self._row['code'],
+                         self._db.version)
+
 
 class Database:
-    def __init__(self, name):
+    """A database of divisions, stored in data/*name*.db.
+
+    When first used, the database reads all divisions into memory, and builds
+    indexes of their codes, names, coordinates and other values. Only
+    :meth:`get` and :meth:`search` on some fields query the SQLite file; other
+    methods use the indexes.
+
+    Results of :meth:`search`, including failed searches, are kept in a
+    least-recently-used cache of up to *cache_size* queries (see
+    :class:`.cache.LRUCache`). If *cache_ttl* is given, cached results expire
+    after that many seconds. Use ``cache_size=0`` to disable the cache.
+
+    Databases and divisions can be pickled, e.g. to send them to other
+    processes with :py:mod:`multiprocessing`. A pickled division contains
+    only its code, the name of its database and the data :attr:`version`;
+    when unpickled, it is looked up in the first :class:`Database` opened
+    with the same name, e.g. :data:`gb2260.divisions`. A pickled database
+    contains only its name and cache settings, and is loaded again on first
+    use.
+    """
+
+    def __init__(self, name, cache_size=1024, cache_ttl=None):
         self.name = name
         self._index = {}
         self._is_loaded = False
+        self._load_lock = Lock()
+        self._cache = LRUCache(cache_size, cache_ttl) if cache_size else None
+        self._instrument = None
+        _databases.setdefault(name, self)
+
+    def __getstate__(self):
+        cache = self._cache
+        return dict(name=self.name,
+                    cache_size=0 if cache is None else cache.maxsize,
+                    cache_ttl=None if cache is None else cache.ttl)
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+    @property
+    @lazy_load
+    def version(self):
+        """Version of the data: a checksum stored by :meth:`.write_sqlite`.
+
+        Databases written by older versions of this package have version 0.
+        """
+        return self._version
+
+    def _row_factory(self, cur, row):
+        div = Division(cur, row)
+        div._db = self
+        return div
 
     def _load(self):
-        self._objects = set()
-        self._conn = open_sqlite(self.name)
-        self._is_loaded = True
+        with self._load_lock:
+            if self._is_loaded:
+                # Loaded by another thread, while this one waited
+                return
+            state = self._read()
+            self.__dict__.update(state)
+            self.cache_clear()
+            # Set last, so other threads never see a partly loaded database
+            self._is_loaded = True
+
+    def _read(self):
+        """Read the database; return a :py:class:`dict` of attributes.
+
+        Used by :meth:`_load`; the attributes are set only when all are
+        built.
+        """
+        conn = open_sqlite(self.name)
+        conn.row_factory = self._row_factory
+        version = conn.execute('PRAGMA user_version').fetchone()[0]
+
+        # Read all divisions, and build in-memory indexes. These are the
+        # only Division objects created; queries return the same instances.
+        divisions = self._execute('SELECT * FROM codes ORDER BY code',
+                                  conn=conn)
+        columns = {field: [div[field] for div in divisions] for field in
+                   COLUMNS}
+        index = {div.code: div for div in divisions}
+        short = _short_map(columns)
+        roman = _roman_map(columns)
+        values, ambiguous = _value_map(divisions)
+
+        # Normalized and short romanized names in any field, for lookup()
+        roman_any = defaultdict(set)
+        for field in ROMAN_FIELDS:
+            for field_index in (roman[field], short[field]):
+                for key, offsets in field_index.items():
+                    roman_any[key].update(offsets)
+        roman_first = {}
+        for key, offsets in roman_any.items():
+            roman_first[key] = min(offsets)
+            if len(offsets) > 1:
+                ambiguous.add(('roman', key))
+
+        # Names in traditional characters, and an index of their variants,
+        # also used by lookup()
+        columns['name_zh_hant'] = [traditional(name) for name in
+                                   columns['name_zh']]
+        traditional_index = {}
+        priority = COLUMNS.index('name_zh')
+        for i, name in enumerate(columns['name_zh']):
+            for variant in traditional_forms(name) - {name}:
+                traditional_index.setdefault(variant, i)
+                key = (str, variant.lower())
+                existing = values.setdefault(key, (priority, divisions[i]))
+                if existing[1] is not divisions[i]:
+                    ambiguous.add(key)
+
+        isolike, from_isolike = _isolike_map(index)
+
+        return dict(
+            _conn=conn,
+            _version=version,
+            _rows=divisions,
+            _offsets=_offsets(div.code for div in divisions),
+            _columns=columns,
+            _arrays={},
+            _summary=_summary(columns),
+            _grid=_grid(columns),
+            _short=short,
+            _roman=roman,
+            _roman_sorted={field: sorted(keys) for field, keys in
+                           roman.items()},
+            _roman_any=roman_first,
+            _index=index,
+            _values=values,
+            _ambiguous=ambiguous,
+            _traditional=traditional_index,
+            _zh_chars=set(''.join(columns['name_zh'])),
+            _isolike=isolike,
+            _from_isolike=from_isolike,
+            _bitmap=_bitmap(index),
+            )
+
+    def reload(self):
+        """Reload the database on next use.
+
+        The cache is cleared, so later queries see the data as reloaded.
+        """
+        with self._load_lock:
+            if self._is_loaded:
+                self._conn.close()
+            self._index = {}
+            self._is_loaded = False
+            self.cache_clear()
+
+    def cache_info(self):
+        """Return statistics for the query cache.
+
+        The result is a :data:`.cache.CacheInfo` with the numbers of hits,
+        misses and evictions, and the maximum and current size; or
+        :py:data:`None` if the cache is disabled.
+        """
+        return None if self._cache is None else self._cache.info()
+
+    def cache_clear(self):
+        """Discard all cached query results."""
+        if self._cache is not None:
+            self._cache.clear()
+
+    def _peek(self, method, *args, **kwargs):
+        """Return the cached result of calling *method* with *args*, *kwargs*.
+
+        Raises :py:class:`KeyError` if the result is not cached; or, if a
+        :py:class:`LookupError` was cached, raises it again.
+        """
+        if self._cache is None:
+            raise KeyError(method)
 
-    def _get_by_code(self, code):
         try:
-            return self._index[code]
-        except KeyError:
-            result = self._select('code = ?', (code,))
-            if len(result) == 0:
-                raise InvalidCodeError(code)
-            return result[0]
+            k = (method,) + _cache_keys[method](*args, **kwargs)
+            result = self._cache.peek(k)
+        except (TypeError, ValueError):
+            raise KeyError(method)
+
+        if isinstance(result, _Raise):
+            raise result.cls(*result.args)
+        return result
+
+    def instrument(self, enabled=True, before=None, after=None):
+        """Enable or disable instrumentation.
+
+        While enabled, calls to the public query methods are counted and
+        timed, as are the SQL statements they execute, and hits on the
+        in-memory index of divisions. Enabling resets all counters. *before*
+        and *after* are optional callbacks; see
+        :class:`.instrument.Instrumentation`.
+        """
+        self._instrument = Instrumentation(before, after) if enabled else \
+            None
+
+    def stats(self):
+        """Return a snapshot of statistics.
+
+        The result is a :py:class:`dict` with the key 'cache', giving the
+        statistics of the query cache (see :meth:`cache_info`) and its hit
+        ratio. If instrumentation is enabled (see :meth:`instrument`), the
+        keys 'calls' (per method), 'sql' and 'index' are also included.
+        """
+        result = {}
+        if self._instrument is not None:
+            result.update(self._instrument.snapshot())
+
+        info = self.cache_info()
+        if info is None:
+            result['cache'] = None
+        else:
+            result['cache'] = info._asdict()
+            lookups = info.hits + info.misses
+            result['cache']['hit_ratio'] = info.hits / lookups if lookups \
+                else None
+
+        return result
+
+    def _get_by_code(self, code):
+        """Return the division with *code*; the database must be loaded."""
+        offset = self._offsets[code] if 0 <= code < CODE_SPACE else -1
+        if self._instrument is None:
+            if offset >= 0:
+                return self._rows[offset]
+        elif offset >= 0:
+            self._instrument.index_hits += 1
+            return self._rows[offset]
+        else:
+            self._instrument.index_misses += 1
+        raise InvalidCodeError(code)
+
+    def _execute(self, sql, args=(), divisions=True, conn=None):
+        """Execute *sql* and return all result rows.
+
+        If *divisions* is :py:data:`False`, rows are returned as tuples.
+        *conn* is a connection to use, instead of the one opened by
+        :meth:`_load`.
+        """
+        cur = (self._conn if conn is None else conn).cursor()
+        if not divisions:
+            cur.row_factory = None
+
+        if self._instrument is None:
+            return cur.execute(sql, args).fetchall()
+
+        start = perf_counter()
+        result = cur.execute(sql, args).fetchall()
+        self._instrument.sql.add(perf_counter() - start)
+        return result
 
     @lazy_load
     def _select(self, condition='', args=()):
-        sql = 'SELECT * FROM codes' + (' WHERE %s' % condition if
-                                       len(condition) else '')
-        result = self._conn.execute(sql, args).fetchall()
-        for div in result:
-            self._objects.add(div)
-            self._index[div.code] = div
-        return result
+        """Return the divisions matching the SQL *condition*.
+
+        Only codes are read from the database; the results are the instances
+        created by :meth:`_load`, so there is one :class:`Division` per code.
+        """
+        sql = 'SELECT code FROM codes' + (' WHERE %s' % condition if
+                                          len(condition) else '')
+        rows, offsets = self._rows, self._offsets
+        return [rows[offsets[code]] for code, in
+                self._execute(sql, args, divisions=False)]
 
+    @instrumented
     def all_at_level(self, level):
         if level not in (1, 2, 3):
             raise ValueError('level must be in 1, 2, 3')
-        return self._select('level = ?', (level,))
+        return list(self.iter(level=level))
+
+    @instrumented
+    @lazy_load
+    def iter(self, level=None, within=None):
+        """Return an iterator over divisions, in order of code.
+
+        If *level* is given, only divisions at that level are included. If
+        *within* is given, only divisions within that division, including
+        itself (see :meth:`gb2260.within`).
+
+        Divisions are read from memory as the iterator advances, so no list of
+        results is built; the divisions within a code are found by bisection.
+        Iterating over the database itself is the same as ``iter()``.
+        """
+        if level not in (None, 1, 2, 3):
+            raise ValueError('level must be in 1, 2, 3')
+
+        rows = self._rows
+        start, stop = 0, len(rows)
+
+        if within is not None:
+            within = _coerce(within)
+            codes = self._columns['code']
+            start = bisect_left(codes, within)
+            stop = bisect_left(codes, within + _span(within), start)
+
+        if level is None:
+            return islice(rows, start, stop)
+
+        levels = self._columns['level']
+        return (rows[i] for i in range(start, stop) if levels[i] == level)
+
+    def _bbox_offsets(self, south, west, north, east):
+        """Return the sorted offsets of divisions in a bounding box."""
+        lat, lon = self._columns['latitude'], self._columns['longitude']
+        rows = range(floor(south / GRID_SIZE), floor(north / GRID_SIZE) + 1)
+        cols = range(floor(west / GRID_SIZE), floor(east / GRID_SIZE) + 1)
+
+        if len(rows) * len(cols) > len(self._grid):
+            # Fewer occupied cells than cells in the box
+            cells = (offsets for (r, c), offsets in self._grid.items() if
+                     r in rows and c in cols)
+        else:
+            cells = (self._grid.get((r, c), ()) for r in rows for c in cols)
+
+        return sorted(i for offsets in cells for i in offsets if
+                      south <= lat[i] <= north and west <= lon[i] <= east)
+
+    def _filter(self, offsets, level, within):
+        """Return divisions at *offsets*, at *level* and *within* a code."""
+        if level not in (None, 1, 2, 3):
+            raise ValueError('level must be in 1, 2, 3')
+        if within is not None:
+            within = _coerce(within)
+            span = _span(within)
+
+        codes, levels = self._columns['code'], self._columns['level']
+        return [self._rows[i] for i in offsets if
+                (level is None or levels[i] == level) and
+                (within is None or codes[i] - codes[i] % span == within)]
+
+    @instrumented
+    @lazy_load
+    def in_bbox(self, south, west, north, east, level=None, within=None):
+        """Return the divisions with coordinates in a bounding box.
+
+        The box includes its edges: latitudes from *south* to *north*, and
+        longitudes from *west* to *east*, in degrees. *level* and *within*
+        filter the results, as for :meth:`iter`. Results are in order of code.
+
+        Divisions without a latitude and longitude are never included; see
+        the 'coverage' in :meth:`summary`. The divisions are found using a
+        grid of cells of :data:`GRID_SIZE` degrees.
+        """
+        if south > north or west > east:
+            raise ValueError('empty bounding box')
+        return self._filter(self._bbox_offsets(south, west, north, east),
+                            level, within)
+
+    @instrumented
+    @lazy_load
+    def within_radius(self, lat, lon, km, level=None, within=None):
+        """Return the divisions within *km* kilometres of (*lat*, *lon*).
+
+        Distances are great-circle (haversine) distances between coordinates.
+        Results are in order of distance, nearest first. *level* and *within*
+        filter the results, as for :meth:`iter`. As for :meth:`in_bbox`,
+        divisions without coordinates are never included.
+        """
+        if km < 0:
+            raise ValueError('radius must not be negative')
+
+        # Bounding box of the circle
+        r = km / EARTH_RADIUS
+        south, north = lat - degrees(r), lat + degrees(r)
+        if south <= -90 or north >= 90 or sin(r) >= cos(radians(lat)):
+            # The circle contains a pole: all longitudes
+            west, east = -180, 180
+        else:
+            dlon = degrees(asin(sin(r) / cos(radians(lat))))
+            west, east = lon - dlon, lon + dlon
+        offsets = self._bbox_offsets(max(south, -90), west, min(north, 90),
+                                     east)
+
+        lats, lons = self._columns['latitude'], self._columns['longitude']
+        found = []
+        for i in offsets:
+            if lats[i] is None or lons[i] is None:
+                continue
+            d = _haversine(lat, lon, lats[i], lons[i])
+            if d <= km:
+                found.append((d, i))
+        found.sort()
+
+        return self._filter([i for d, i in found], level, within)
+
+    def _distance_codes(self, codes, level, within):
+        """Return a NumPy array of *codes*, or of those at *level*/*within*."""
+        import numpy as np
+
+        if codes is None:
+            return np.array([div.code for div in self.iter(level, within)],
+                            dtype=np.int64)
+        codes = np.array(self.take(codes, 'code'), dtype=np.int64)
+        return codes.ravel()
+
+    @instrumented
+    @lazy_load
+    def distance_blocks(self, codes=None, level=None, within=None,
+                        block_size=1024):
+        """Iterate over blocks of rows of a matrix of distances.
+
+        The arguments are as for :meth:`distances`. Yields ``(start, block)``,
+        where *block* is a NumPy array with the distances from the divisions
+        *start*, *start* + 1, … to all the divisions, and at most
+        *block_size* rows. Only one block is held in memory at a time, so
+        this can be used for large sets of divisions. Requires NumPy.
+        """
+        import numpy as np
+
+        codes = self._distance_codes(codes, level, within)
+        offsets = self._numpy_offsets(codes)[1]
+        lat = np.radians(self._array('latitude').take(offsets))
+        lon = np.radians(self._array('longitude').take(offsets))
+
+        def blocks():
+            for start in range(0, len(codes), block_size):
+                stop = start + block_size
+                yield start, _haversine_block(np, lat[start:stop],
+                                              lon[start:stop], lat, lon)
+
+        return blocks()
+
+    @instrumented
+    @lazy_load
+    def distances(self, codes=None, level=None, within=None, condensed=False,
+                  cache_dir=None):
+        """Return the great-circle distances in km between divisions.
+
+        The divisions are either *codes*, or else those selected by *level*
+        and *within*, as for :meth:`iter`. Returns a :data:`DistanceMatrix`
+        ``(codes, distances)``, where *codes* is a NumPy array of the codes of
+        the divisions, and *distances* is a square NumPy array of the
+        (haversine) distances between them. If *condensed* is
+        :py:data:`True`, *distances* is instead a 1-dimensional array of the
+        distances between divisions *i* and *j* for *i* < *j*, in the same
+        order as :func:`scipy.spatial.distance.pdist`. Distances to divisions
+        without coordinates are NaN.
+
+        Distances are computed with NumPy, in blocks of rows as by
+        :meth:`distance_blocks`. If *cache_dir* is given, the matrix of
+        distances between all divisions at *level* (or all divisions, if
+        *level* is :py:data:`None`) is stored in that directory, as a
+        ``.npy`` file for the current :attr:`version` of the data. It is read
+        memory-mapped by later calls, and the distances between the selected
+        divisions, which must be at *level*, are taken from it.
+
+        >>> divisions.distances(within=110000, level=3).distances.shape
+        (16, 16)
+
+        Requires NumPy.
+        """
+        import numpy as np
+
+        selected = self._distance_codes(codes, level, within)
+        n = len(selected)
+
+        if cache_dir is None:
+            blocks = self.distance_blocks(selected)
+        else:
+            all_codes, full = self._cached_distances(level, cache_dir)
+            index = np.searchsorted(all_codes, selected)
+            if n and not np.array_equal(
+                    all_codes.take(np.minimum(index, len(all_codes) - 1)),
+                    selected):
+                raise ValueError('codes must be at level %s' % level)
+            blocks = ((start, full[index[start:start + 1024]][:, index]) for
+                      start in range(0, n, 1024))
+
+        if condensed:
+            # Copy the part of each row above the diagonal, so the square
+            # matrix is never held in memory
+            result = np.empty(n * (n - 1) // 2)
+            pos = 0
+            for start, block in blocks:
+                for i, row in enumerate(block, start):
+                    result[pos:pos + n - i - 1] = row[i + 1:]
+                    pos += n - i - 1
+        else:
+            result = np.empty((n, n))
+            for start, block in blocks:
+                result[start:start + len(block)] = block
+
+        return DistanceMatrix(selected, result)
+
+    def _cached_distances(self, level, cache_dir):
+        """Return codes and distances for all divisions at *level*.
+
+        The matrix is stored in *cache_dir*, and read memory-mapped.
+        """
+        import numpy as np
+
+        codes = self._distance_codes(None, level, None)
+        fn = os.path.join(cache_dir, 'distances-%s-%d-%s.npy' % (
+            self.name, self.version, 'all' if level is None else level))
+
+        if not os.path.exists(fn):
+            os.makedirs(cache_dir, exist_ok=True)
+            tmp_fn = _temp_file(fn, '.distances-')
+            try:
+                matrix = np.lib.format.open_memmap(
+                    tmp_fn, mode='w+', shape=(len(codes), len(codes)))
+                for start, block in self.distance_blocks(codes):
+                    matrix[start:start + len(block)] = block
+                matrix.flush()
+                del matrix
+                os.replace(tmp_fn, fn)
+            except BaseException:
+                os.remove(tmp_fn)
+                raise
+
+        return codes, np.load(fn, mmap_mode='r')
+
+    @lazy_load
+    def summary(self):
+        """Return summary statistics of the divisions.
+
+        The result is a :py:class:`dict` with the keys:
+
+        - 'count': the number of divisions.
+        - 'levels': a :py:class:`dict` mapping levels to numbers of divisions.
+        - 'children': a :py:class:`dict` mapping the code of every division to
+          the number of divisions of which it is the :meth:`gb2260.parent`.
+        - 'coverage': a :py:class:`dict` mapping each field in
+          :data:`COLUMNS` to the number of divisions with a non-empty value.
+
+        The same object is returned on every call; it should not be modified.
+        """
+        return self._summary
 
     def get(self, code=None, **kwarg):
+        # The common case, a code, is answered inline: this is the hot path.
+        # Other cases, and calls while instrumentation is enabled, use _get().
+        if self._instrument is not None:
+            return self._instrument.call('get', Database._get, (self, code),
+                                         kwarg)
+        elif not self._is_loaded:
+            self._load()
+        if code is not None and not kwarg:
+            code = int(code)
+            offset = self._offsets[code] if 0 <= code < CODE_SPACE else -1
+            if offset < 0:
+                raise InvalidCodeError(code)
+            return self._rows[offset]
+        return self._get(code, **kwarg)
+
+    @lazy_load
+    def _get(self, code=None, **kwarg):
         if len(kwarg) > 1 or (len(kwarg) and code is not None):
             raise TypeError('Only one criterion may be given')
         elif len(kwarg) == 0:
@@ -155,40 +1064,60 @@ class Database:
 
         return div
 
-    def lookup(self, value):
-        """Return first value matching the *kwargs."""
-        types = {
-            'code': int,
-            'name_zh': str,
-            'level': int,
-            'name_pinyin': str,
-            'name_en': str,
-            'alpha': str,
-            'latitude': float,
-            'longitude': float,
-            }
-        conditions = []
-        args = []
-        for field, ftype in types.items():
+    @instrumented
+    @lazy_load
+    def lookup(self, value, strict=False):
+        """Return the division with any field matching *value*.
+
+        *value* is converted to the type of each field; matches on strings
+        are case-insensitive. If the value matches several fields, the first
+        of :data:`COLUMNS` is used; if it matches several divisions in that
+        field, the one with the lowest code. If *strict* is
+        :py:data:`True`, a value matching more than one division raises
+        :class:`AmbiguousRegionError`.
+        """
+        result = self._lookup(value)
+        if result is None:
+            raise LookupError('Could not find a record for %r' % value)
+        key, div = result
+        if strict and key in self._ambiguous:
+            raise AmbiguousRegionError('%r matches more than one division' %
+                                       value)
+        return div
+
+    @instrumented
+    @lazy_load
+    def lookup_many(self, values):
+        """Return a list of the results of :meth:`lookup` for *values*.
+
+        Where a value matches no division, the list contains
+        :py:data:`None`.
+        """
+        lookup = self._lookup
+        return [None if r is None else r[1] for r in map(lookup, values)]
+
+    def _lookup(self, value):
+        """Return (key, division) for the best match to *value*, or None."""
+        best = None
+        for key in _value_keys(value):
             try:
-                # Convert the argument to the field's type
-                args.append(ftype(value))
-                conditions.append('%s %s ?' % (
-                    field,
-                    'LIKE' if ftype == str else '=',
-                    ))
-            except ValueError:
+                priority, div = self._values[key]
+            except KeyError:
                 continue
-        condition = ' OR '.join(conditions) + 'LIMIT 1'
-        result = self._select(condition, args)
-        if len(result):
-            return result[0]
-        else:
-            raise LookupError('Could not find a record for %r' % value)
+            if best is None or priority < best[0]:
+                best = (priority, key, div)
+        if best is None and isinstance(value, str):
+            # Romanized names, ignoring case, spaces, apostrophes and suffixes
+            for key in (roman_key(value), short_roman(value)):
+                if key in self._roman_any:
+                    return ('roman', key), self._rows[self._roman_any[key]]
+        return None if best is None else best[1:]
 
     _search_partial_replace = """replace(replace(%s," ",""),"'","") LIKE ?"""
     _search_partial_translate = str.maketrans('', '', "' ")
 
+    @instrumented
+    @cached(_search_key)
     def search(self, **kwargs):
         """Lookup information from the database.
 
@@ -234,7 +1163,20 @@ class Database:
 
         - *partial*: if True, the search value is matched at the beginning of
           strings like name_zh and name_en, instead of matching the entire
-          string. The match is case sensitive.
+          string.
+
+        - *short*: if True, the search value is matched on the short forms of
+          names in name_zh, name_pinyin or name_en, without suffixes such as
+          区 or 'qu' (see :mod:`gb2260.names`).
+
+            >>> lookup(name_zh='海淀', short=True)
+            110108
+
+        Values for name_zh may be in simplified or traditional characters.
+        Values for name_pinyin and name_en are matched ignoring case, tone
+        marks, spaces and apostrophes (see :func:`.names.roman_key`); if no
+        name matches exactly, the short forms are tried, so e.g. 'Guang Zhou'
+        and 'Guangzhou Shi' both find 广州市.
 
         Further examples:
 
@@ -248,14 +1190,11 @@ class Database:
         within = kwargs.pop('within', None)
 
         if within is not None:
-            # Split the code to parts, increment the one at the relevant level,
-            # and rejoin
-            parts = list(split(within))
-            parts[_level(within) - 1] += 1
-            high = _join(parts)
-
-            # Add to the query expressions
-            conditions.append('AND code BETWEEN %d AND %d' % (within, high))
+            # Codes from *within* up to the next division at the same level,
+            # as for the in-memory searches
+            within = _coerce(within)
+            conditions.append('AND code >= %d AND code < %d' % (
+                within, within + _span(within)))
 
         # Limit search to administrative level *level*
         level = kwargs.pop('level', None)
@@ -270,8 +1209,11 @@ class Database:
                 raise ValueError(("level should be in (1, 2, 3, lowest, "
                                   "highest); received %s") % level)
 
-        # Partial match
+        # Partial match, or match on short names
         partial = kwargs.pop('partial', False)
+        short = kwargs.pop('short', False)
+        if partial and short:
+            raise ValueError('partial and short may not both be given')
 
         # The only remaining argument's name is the column to query on; its
         # value is the value to look up.
@@ -281,33 +1223,674 @@ class Database:
         elif key not in COLUMNS:
             raise ValueError('invalid field name: %s' % key)
 
-        if partial:
-            conditions.insert(0, self._search_partial_replace % key)
-            value = value.translate(self._search_partial_translate) + '%'
-        else:
-            conditions.insert(0, '%s = ?' % key)
+        if key == 'name_zh' and isinstance(value, str):
+            # Accept names in traditional characters
+            value = self._simplified(value)
+
+        roman = key in ROMAN_FIELDS and isinstance(value, str)
 
         # Retrieve the results
-        result = self._select(' '.join(conditions), (value,))
+        if short:
+            result = self._search_short(key, value, within, level)
+        elif roman:
+            result = self._search_roman(key, value, partial, within, level)
+        else:
+            if partial:
+                conditions.insert(0, self._search_partial_replace % key)
+                value = value.translate(self._search_partial_translate) + '%'
+            else:
+                conditions.insert(0, '%s = ?' % key)
+            result = self._select(' '.join(conditions), (value,))
         if len(result) != 1:
-            error_str = '%s with args %s' % (conditions, value)
+            if short or roman:
+                error_str = '%s%s %s %r with within=%s, level=%s' % (
+                    'short ' if short else '', key,
+                    'starts with' if partial else '=', value, within, level)
+            else:
+                error_str = '%s with args %s' % (conditions, value)
             ErrorCls = AmbiguousRegionError if len(result) else RegionKeyError
             raise ErrorCls(error_str)
 
         return result[0]
 
+    @lazy_load
+    def _simplified(self, name):
+        """Return the Chinese *name* in simplified characters.
+
+        Names that use only characters of the names in the database are
+        returned unchanged, since conversion may alter them, e.g. 叠 to 迭.
+        """
+        if self._zh_chars.issuperset(name):
+            return name
+        try:
+            return self._columns['name_zh'][self._traditional[name]]
+        except KeyError:
+            return simplified(name)
+
+    @lazy_load
+    def _search_short(self, key, value, within, level):
+        """Return divisions with the same short *key* as *value*."""
+        try:
+            short = SHORT_FORMS[key]
+        except KeyError:
+            raise ValueError('no short names for field: %s' % key)
+
+        return self._pick(self._short[key].get(short(value), ()), within,
+                          level)
+
+    @lazy_load
+    def _search_roman(self, key, value, partial, within, level):
+        """Return divisions with romanized names in *key* matching *value*."""
+        index = self._roman[key]
+        value = roman_key(value)
+        if partial:
+            keys = self._roman_sorted[key]
+            offsets = []
+            for k in islice(keys, bisect_left(keys, value), None):
+                if not k.startswith(value):
+                    break
+                offsets.extend(index[k])
+            offsets.sort()
+        else:
+            offsets = index.get(value) or self._short[key].get(
+                short_roman(value), ())
+        return self._pick(offsets, within, level)
+
+    def _pick(self, offsets, within, level):
+        """Return divisions at *offsets*, filtered as by :meth:`search`."""
+        result = self._filter(offsets, level if level in (1, 2, 3) else None,
+                              within)
+
+        if level in ('highest', 'lowest') and len(result):
+            pick = min if level == 'highest' else max
+            result = [pick(result, key=lambda div: div.level)]
+
+        return result
+
+    @instrumented
+    @lazy_load
+    def search_ranked(self, k=5, context=None, **kwargs):
+        """Return the *k* best candidates for a name, with scores.
+
+        Exactly one keyword argument gives a name field and the value to look
+        up, as for :meth:`search`: name_zh (in simplified or traditional
+        characters), name_pinyin or name_en. Instead of raising
+        :class:`AmbiguousRegionError` or :class:`RegionKeyError`, all the
+        divisions matching the name exactly or by its short form are scored,
+        and the result is a list of :data:`Candidate` ``(score, division,
+        match)``, from the highest score to the lowest; *match* is 'exact' or
+        'short'. The list is empty if nothing matches.
+
+        >>> [c.division.code for c in search_ranked(name_zh='朝阳', k=3)]
+        [110105, 211300, 211321]
+
+        *context* is an optional :py:class:`dict` of hints, which raise the
+        scores of candidates without excluding others:
+
+        - *within*: a code, e.g. of the province or prefecture where the
+          division is expected. Candidates within the same province score
+          half as much as those within the code itself.
+        - *near*: a tuple (latitude, longitude). The score decreases with the
+          distance of each candidate from this point; see
+          :data:`RANK_DISTANCE`.
+        - *level*: the expected administrative level, 1, 2 or 3.
+
+        >>> search_ranked(name_zh='朝阳', k=1,
+        ...               context=dict(within=220000))[0].division.code
+        220104
+
+        The weights of the parts of the score are in :data:`RANK_WEIGHTS`. If
+        *k* is :py:data:`None`, all candidates are returned.
+        """
+        context = dict(context or {})
+        within = context.pop('within', None)
+        near = context.pop('near', None)
+        level = context.pop('level', None)
+        if len(context):
+            raise ValueError('unexpected context: %s' % list(context.keys()))
+        elif level not in (None, 1, 2, 3):
+            raise ValueError('level must be in 1, 2, 3')
+
+        key, value = kwargs.popitem()
+        if len(kwargs):
+            raise ValueError('unexpected arguments: %s' % kwargs.keys())
+        elif key not in SHORT_FORMS:
+            raise ValueError('no ranked search for field: %s' % key)
+
+        # Offsets of the candidates, and the quality of each match
+        if key == 'name_zh':
+            value = self._simplified(value)
+            exact = [i for i in self._short[key].get(short_zh(value), ()) if
+                     self._columns[key][i] == value]
+        else:
+            exact = self._roman[key].get(roman_key(value), ())
+        matches = dict.fromkeys(
+            self._short[key].get(SHORT_FORMS[key](value), ()), 'short')
+        matches.update(dict.fromkeys(exact, 'exact'))
+
+        if within is not None:
+            within = _coerce(within)
+            span = _span(within)
+        codes, levels = self._columns['code'], self._columns['level']
+        lats, lons = self._columns['latitude'], self._columns['longitude']
+        weights = RANK_WEIGHTS
+
+        result = []
+        for i, match in matches.items():
+            score = weights[match]
+            if within is not None:
+                if codes[i] - codes[i] % span == within:
+                    score += weights['within']
+                elif codes[i] // 10000 == within // 10000:
+                    score += weights['within'] / 2
+            if near is not None and lats[i] is not None and \
+                    lons[i] is not None:
+                d = _haversine(near[0], near[1], lats[i], lons[i])
+                score += weights['near'] * RANK_DISTANCE / (RANK_DISTANCE + d)
+            if level is not None and levels[i] == level:
+                score += weights['level']
+            result.append(Candidate(score, self._rows[i], match))
+
+        result.sort(key=lambda c: (-c.score, c.division.code))
+        return result if k is None else result[:k]
+
+    @instrumented
+    @lazy_load
     def stack(self, code):
         return tuple(map(self._get_by_code,
                          sorted(set(_parents(_coerce(code))))))
 
+    @lazy_load
+    def is_valid(self, code):
+        """Return :py:data:`True` if *code* is the code of a division.
+
+        Unlike :meth:`get`, no exception is raised for invalid codes. Codes are
+        checked in a bitmap of all valid codes. Numbers that are not integers,
+        e.g. 110108.5, are not valid codes.
+        """
+        try:
+            value = int(code)
+        except (TypeError, ValueError, OverflowError):
+            return False
+        if value != code and not isinstance(code, str):
+            return False
+        code = value
+        return 0 <= code < CODE_SPACE and \
+            bool(self._bitmap[code >> 3] & (1 << (code & 7)))
+
+    @lazy_load
+    def valid_mask(self, codes):
+        """Return a mask with the results of :meth:`is_valid` for *codes*.
+
+        If *codes* is a NumPy array, the result is a NumPy boolean array,
+        computed without a Python loop. Otherwise, the result is a
+        :py:class:`bytearray` with one element per code, 1 for valid codes and
+        0 for others; use e.g. ``numpy.frombuffer(mask, bool)`` to view it as
+        an array.
+        """
+        if _is_numpy(codes):
+            import numpy as np
+
+            codes = np.asarray(codes)
+            if codes.dtype.kind not in 'iuf':
+                codes = codes.astype(np.int64)
+            in_range = (codes >= 0) & (codes < CODE_SPACE)
+            if codes.dtype.kind == 'f':
+                # Only integral values
+                in_range &= codes == np.floor(codes)
+            codes = np.where(in_range, codes, 0).astype(np.int64)
+            bits = np.frombuffer(self._bitmap, dtype=np.uint8)
+            return in_range & (bits[codes >> 3] >> (codes & 7) & 1 == 1)
+
+        codes = list(codes)
+        bits = self._bitmap
+        try:
+            return bytearray(bits[c >> 3] >> (c & 7) & 1 if 0 <= c < CODE_SPACE
+                             else 0 for c in codes)
+        except TypeError:
+            # Some codes are not integers
+            return bytearray(map(self.is_valid, codes))
+
+    @instrumented
+    @lazy_load
+    def take(self, codes, field=None):
+        """Return the divisions for *codes*, or their values of *field*.
+
+        Each code is looked up in a table of row offsets, indexed by code. If
+        *codes* is a NumPy array, the result is a NumPy array of the same
+        shape, gathered with a single :func:`numpy.take`; its type is that of
+        *field* (missing latitudes and longitudes are NaN), or object for
+        divisions and strings. Otherwise, the result is a list.
+
+        Besides the fields in :data:`COLUMNS`, *field* may be 'name_zh_hant':
+        name_zh in traditional characters, from :func:`.names.traditional`.
+
+        Raises :class:`InvalidCodeError` if any code is invalid, and
+        :py:class:`ValueError` if *field* is not a field name.
+
+        >>> divisions.take([110000, 130100], 'name_en')
+        ['Beijing', 'Shijiazhuang']
+        """
+        if field is not None and field not in self._columns:
+            raise ValueError('invalid field name: %s' % field)
+
+        if _is_numpy(codes):
+            return self._take_numpy(codes, field)
+
+        codes, offsets = self._list_offsets(codes)
+
+        if -1 in offsets:
+            raise InvalidCodeError(codes[offsets.index(-1)])
+
+        values = self._rows if field is None else self._columns[field]
+        return [values[i] for i in offsets]
+
+    def _list_offsets(self, codes):
+        """Return lists of *codes*, as integers, and their row offsets, or -1.
+        """
+        codes = list(codes)
+        table = self._offsets
+        try:
+            offsets = [table[c] if 0 <= c < CODE_SPACE else -1 for c in codes]
+        except TypeError:
+            # Some codes are not integers
+            codes = [_coerce(c) for c in codes]
+            offsets = [table[c] if 0 <= c < CODE_SPACE else -1 for c in codes]
+        return codes, offsets
+
+    def _take_numpy(self, codes, field):
+        codes, offsets = self._numpy_offsets(codes)
+
+        invalid = offsets < 0
+        if invalid.any():
+            raise InvalidCodeError(codes[invalid].flat[0].item())
+
+        return self._array(field).take(offsets)
+
+    def _numpy_offsets(self, codes):
+        """Return NumPy arrays of *codes* and their row offsets, or -1."""
+        import numpy as np
+
+        codes = np.asarray(codes)
+        if codes.dtype.kind not in 'iu':
+            codes = codes.astype(np.int64)
+        in_range = (codes >= 0) & (codes < CODE_SPACE)
+        table = np.frombuffer(self._offsets, dtype='i%d' %
+                              self._offsets.itemsize)
+        offsets = np.where(in_range, table[np.where(in_range, codes, 0)], -1)
+        return codes, offsets
+
+    def _array(self, field):
+        """Return the values of *field* as a NumPy array, in row order.
+
+        If *field* is :py:data:`None`, the array contains divisions.
+        """
+        try:
+            return self._arrays[field]
+        except KeyError:
+            pass
+
+        import numpy as np
+
+        # Convert the column to an array on first use
+        if field is None:
+            values = np.empty(len(self._rows), dtype=object)
+            for i, div in enumerate(self._rows):
+                values[i] = div
+        elif FIELD_TYPES.get(field, str) is str:
+            values = np.array(self._columns[field], dtype=object)
+        else:
+            values = np.array([np.nan if v is None else v for v in
+                               self._columns[field]], dtype=FIELD_TYPES[field])
+        self._arrays[field] = values
+        return values
+
+    def parent(self, code, parent_level=None):
+        """Return a valid code that is the parent of *code*.
+
+        See :meth:`gb2260.parent`.
+        """
+        code_level = _level(code)
+        parents_guess = _parents(code)
+
+        parents_db = self.stack(code)
+
+        if code not in parents_db:
+            raise InvalidCodeError(code)
+
+        if parent_level is None:
+            parent_level = code_level - 1
+
+        if parent_level not in (1, 2, 3):
+            raise ValueError('level = %d' % parent_level)
+
+        guess = parents_guess[parent_level - 1]
+        if guess not in parents_db:
+            raise ValueError('code %d is at level %d, no parent at level %d' %
+                             (code, code_level, parent_level))
+        else:
+            return guess
+
+    @instrumented
+    @lazy_load
+    def parent_many(self, codes, parent_level=None):
+        """Return the parents of *codes*, and a mask of errors.
+
+        For each code, the result is the same as from :meth:`gb2260.parent`:
+        the parent at level *parent_level*, by default the level above the
+        code. Instead of raising an exception for an invalid code, or for a
+        parent that does not exist, the parent is 0 and the error mask is
+        set. The levels of codes and the existence of parents are checked in
+        the table of row offsets.
+
+        If *codes* is a NumPy array, the parents and mask are NumPy arrays of
+        integers and booleans, computed without a Python loop. Otherwise, the
+        parents are an :py:class:`array.array` of integers, and the mask a
+        :py:class:`bytearray` with 1 for errors and 0 for others.
+
+        >>> parents, errors = divisions.parent_many([110108, 110000, 990101])
+        >>> list(parents), list(errors)
+        ([110100, 0, 0], [0, 1, 1])
+        """
+        if parent_level not in (None, 1, 2, 3):
+            raise ValueError('level = %d' % parent_level)
+
+        if _is_numpy(codes):
+            return self._parent_many_numpy(codes, parent_level)
+
+        # Divisors giving the parent of a code at each level
+        divisors = (None, 10000, 100, 1)
+        table = self._offsets
+        levels = self._columns['level']
+
+        def _parent(code):
+            offset = table[code] if 0 <= code < CODE_SPACE else -1
+            if offset < 0:
+                return 0
+            level = levels[offset] - 1 if parent_level is None else \
+                parent_level
+            if level == 0:
+                return 0
+            result = code - code % divisors[level]
+            return result if table[result] >= 0 else 0
+
+        def _coerce_or_invalid(code):
+            try:
+                return int(code)
+            except (TypeError, ValueError):
+                return -1
+
+        codes = list(codes)
+        try:
+            parents = array('i', map(_parent, codes))
+        except TypeError:
+            # Some codes are not integers
+            parents = array('i', (_parent(_coerce_or_invalid(c)) for c in
+                                  codes))
+        return parents, bytearray(p == 0 for p in parents)
+
+    def _parent_many_numpy(self, codes, parent_level):
+        import numpy as np
+
+        codes, offsets = self._numpy_offsets(codes)
+        valid = offsets >= 0
+
+        if parent_level is None:
+            levels = self._array('level').take(np.where(valid, offsets, 0))
+            divisors = np.array([1, 10000, 100, 1]).take(levels - 1)
+            valid &= levels > 1
+        else:
+            divisors = (None, 10000, 100, 1)[parent_level]
+
+        parents = np.where(valid, codes - codes % divisors, 0)
+        valid &= self._numpy_offsets(parents)[1] >= 0
+        return np.where(valid, parents, 0), ~valid
+
+    @instrumented
+    @lazy_load
+    def rollup(self, codes, values=None, levels=(1, 2), stats=ROLLUP_STATS):
+        """Aggregate *values* for *codes* up to the divisions at *levels*.
+
+        *codes* and *values* are sequences of the same length; or *codes* is
+        a mapping from codes to values, and *values* is omitted. Each value
+        is added to the division at each of *levels* that contains its code,
+        i.e. the :meth:`gb2260.parent` at that level, or the code itself if
+        it is at that level. Codes at a level above one of *levels* are not
+        included in the aggregates for that level. *stats* are any of
+        :data:`ROLLUP_STATS`.
+
+        Returns a :data:`Rollup` ``(aggregates, unmatched)``. *aggregates*
+        maps each of *levels* to a :py:class:`dict`, which maps codes to a
+        :py:class:`dict` of *stats*:
+
+        >>> r = divisions.rollup([110101, 110108, 120101], [1, 2, 4])
+        >>> r.aggregates[1][110000]
+        {'count': 2, 'sum': 3, 'mean': 1.5, 'min': 1, 'max': 2}
+
+        *unmatched* maps each of *levels* to a sorted list of codes that could
+        not be aggregated at that level: codes that are not in the database,
+        and codes with no parent at that level, e.g. county-level divisions
+        directly under a province.
+
+        If *codes* or *values* are NumPy arrays, the grouping is done with
+        NumPy, without a Python loop over codes; all statistics except counts
+        are then floats.
+        """
+        if values is None:
+            codes, values = zip(*codes.items()) if len(codes) else ((), ())
+
+        for level in levels:
+            if level not in (1, 2, 3):
+                raise ValueError('level must be in 1, 2, 3')
+        for stat in stats:
+            if stat not in ROLLUP_STATS:
+                raise ValueError('unknown statistic: %s' % stat)
+
+        if _is_numpy(codes) or _is_numpy(values):
+            return self._rollup_numpy(codes, values, levels, stats)
+
+        codes, offsets = self._list_offsets(codes)
+        values = list(values)
+        if len(values) != len(codes):
+            raise ValueError('codes and values have different lengths')
+
+        table = self._offsets
+        code_levels = self._columns['level']
+        own = [code_levels[o] if o >= 0 else 0 for o in offsets]
+
+        aggregates, unmatched = {}, {}
+        for level in levels:
+            divisor = (None, 10000, 100, 1)[level]
+            groups = {}
+            missed = set()
+            for code, offset, l, value in zip(codes, offsets, own, values):
+                if offset < 0:
+                    missed.add(code)
+                    continue
+                elif l < level:
+                    continue
+
+                parent = code - code % divisor
+                if table[parent] < 0:
+                    missed.add(code)
+                    continue
+
+                # Count, sum, minimum and maximum
+                g = groups.get(parent)
+                if g is None:
+                    groups[parent] = [1, value, value, value]
+                else:
+                    g[0] += 1
+                    g[1] += value
+                    g[2] = min(g[2], value)
+                    g[3] = max(g[3], value)
+
+            aggregates[level] = {
+                parent: _rollup_stats(stats, *g) for parent, g in
+                sorted(groups.items())}
+            unmatched[level] = sorted(missed)
+
+        return Rollup(aggregates, unmatched)
+
+    def _rollup_numpy(self, codes, values, levels, stats):
+        import numpy as np
+
+        codes, offsets = self._numpy_offsets(np.ravel(codes))
+        values = np.ravel(values)
+        if values.shape != codes.shape:
+            raise ValueError('codes and values have different lengths')
+
+        valid = offsets >= 0
+        own = np.where(valid, self._array('level').take(np.where(valid,
+                                                                 offsets, 0)),
+                       0)
+        table = np.frombuffer(self._offsets, dtype='i%d' %
+                              self._offsets.itemsize)
+        n = len(self._rows)
+        all_codes = self._columns['code']
+
+        aggregates, unmatched = {}, {}
+        for level in levels:
+            divisor = (None, 10000, 100, 1)[level]
+            included = valid & (own >= level)
+            parents = table.take(np.where(included, codes - codes % divisor,
+                                          0))
+            matched = included & (parents >= 0)
+            unmatched[level] = np.unique(codes[~valid | (
+                included & (parents < 0))]).tolist()
+
+            # Group by the row offset of the parent
+            group = parents[matched]
+            v = values[matched]
+            count = np.bincount(group, minlength=n)
+            total = np.bincount(group, weights=v, minlength=n)
+            if 'min' in stats:
+                low = np.full(n, np.inf)
+                np.minimum.at(low, group, v)
+            if 'max' in stats:
+                high = np.full(n, -np.inf)
+                np.maximum.at(high, group, v)
+
+            aggregates[level] = {
+                all_codes[i]: _rollup_stats(
+                    stats, count[i].item(), total[i].item(),
+                    low[i].item() if 'min' in stats else None,
+                    high[i].item() if 'max' in stats else None)
+                for i in np.flatnonzero(count).tolist()}
+
+        return Rollup(aggregates, unmatched)
+
+    @instrumented
+    @lazy_load
+    def to_arrow(self):
+        """Return the database as a :class:`pyarrow.Table`.
+
+        The table has the columns in :data:`COLUMNS`, then those in
+        :data:`HIERARCHY_COLUMNS`, with rows in code order. It is read from
+        the Arrow IPC (Feather) file data/*name*.arrow, memory-mapped, so the
+        columns are not copied into memory. If the file is missing or has a
+        different :attr:`version` of the data, it is first written by
+        :meth:`.write_arrow`.
+
+        Requires :py:mod:`pyarrow`, which is an optional dependency.
+        """
+        fn = data_fn(self.name, 'arrow')
+        version = str(self.version).encode()
+
+        if os.path.exists(fn):
+            table = _read_arrow(fn)
+            if table.schema.metadata.get(b'version') == version:
+                return table
+
+        from .admin import write_arrow
+
+        write_arrow(self.name, self._rows, version=self.version)
+        return _read_arrow(fn)
+
+    @instrumented
+    @lazy_load
+    def isolike(self, code, prefix='CN-'):
+        """Return an 'ISO 3166-2-like' alpha code for *code*.
+
+        See :meth:`gb2260.isolike`.
+        """
+        code = _coerce(code)
+        try:
+            result = self._isolike[code]
+        except KeyError:
+            raise InvalidCodeError(code)
+        if result is None:
+            raise ValueError('no alpha code for %d' % code)
+        return prefix + result
+
+    @instrumented
+    @lazy_load
+    def isolike_many(self, codes, prefix='CN-'):
+        """Return a list of the results of :meth:`isolike` for *codes*.
+
+        Where a code is invalid or has no alpha code, the list contains
+        :py:data:`None`.
+        """
+        return [None if r is None else prefix + r for r in
+                map(self._isolike_code, codes)]
+
+    def _isolike_code(self, code):
+        try:
+            return self._isolike.get(_coerce(code))
+        except (TypeError, ValueError):
+            return None
+
+    @instrumented
+    @lazy_load
+    def from_isolike(self, value, prefix='CN-'):
+        """Return the division for an 'ISO 3166-2-like' alpha code *value*.
+
+        The inverse of :meth:`isolike`. *value* is not case-sensitive, and
+        *prefix* is optional.
+
+        >>> divisions.from_isolike('CN-HE-SJW').name_en
+        'Shijiazhuang'
+
+        If *value* is not the code of any division, raises
+        :class:`RegionKeyError`; if it is not a :py:class:`str`, raises
+        :py:class:`TypeError`.
+        """
+        if not isinstance(value, str):
+            raise TypeError('expected str, received %r' % value)
+        result = self._from_isolike_code(value, prefix)
+        if result is None:
+            raise RegionKeyError(value)
+        return self._index[result]
+
+    @instrumented
+    @lazy_load
+    def from_isolike_many(self, values, prefix='CN-'):
+        """Return a list of the results of :meth:`from_isolike` for *values*.
+
+        Where a value is not the code of any division, or not a
+        :py:class:`str`, the list contains :py:data:`None`.
+        """
+        codes = (self._from_isolike_code(v, prefix) for v in values)
+        return [None if code is None else self._index[code] for code in
+                codes]
+
+    def _from_isolike_code(self, value, prefix):
+        if not isinstance(value, str):
+            return None
+        value = value.upper()
+        prefix = prefix.upper()
+        if value.startswith(prefix):
+            value = value[len(prefix):]
+        return self._from_isolike.get(value)
+
+    @instrumented
     def __iter__(self):
-        self._select()  # Load all
-        return iter(self._objects)
+        return self.iter()
 
+    @instrumented
     @lazy_load
     def __len__(self):
-        sql = 'SELECT count(*) FROM codes;'
-        return self._conn.execute(sql).fetchone()._row[0]
+        return len(self._rows)
 
 
 def data_fn(base, ext='csv', path=None):
@@ -321,16 +1904,33 @@ def data_fn(base, ext='csv', path=None):
     return os.path.normpath(os.path.join(path, '%s.%s' % (base, ext)))
 
 
+def _temp_file(fn, prefix):
+    """Create a temporary file in the directory of *fn*; return its name.
+
+    The file has the permissions of a file created normally, rather than the
+    0600 of :py:func:`tempfile.mkstemp`, so they are kept when it replaces
+    *fn*.
+    """
+    fd, tmp_fn = tempfile.mkstemp(suffix=os.path.splitext(fn)[1],
+                                  prefix=prefix, dir=os.path.dirname(fn))
+    os.close(fd)
+    umask = os.umask(0)
+    os.umask(umask)
+    os.chmod(tmp_fn, 0o666 & ~umask)
+    return tmp_fn
+
+
 def open_sqlite(db):
     """Connect to the sqlite3 database in data/*db*.db."""
     db_fn = data_fn(db, 'db')
 
     if not os.path.exists(db_fn):
-        from .admin import write_sqlite, load_csv
+        from .admin import iter_csv, write_sqlite
 
-        write_sqlite(db, load_csv(db, keep_key=True))
+        write_sqlite(db, iter_csv(db))
 
-    conn = sqlite3.connect(db_fn)
+    # The connection may be used by other threads, e.g. by AsyncDatabase
+    conn = sqlite3.connect(db_fn, check_same_thread=False)
     conn.row_factory = Division
 
     return conn
@@ -0,0 +1,135 @@
+from collections import Counter, OrderedDict, defaultdict
+from contextlib import contextmanager
+from time import perf_counter, process_time
+import tracemalloc
+
+
+class Histogram:
+    """Count and total of durations, with counts in power-of-two buckets.
+
+    A duration of *t* microseconds is counted in the bucket with upper bound
+    *b*, the smallest power of two such that *t* < *b*.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.buckets = Counter()
+
+    def add(self, seconds):
+        """Record a duration of *seconds*."""
+        self.count += 1
+        self.total += seconds
+        self.buckets[int(seconds * 1e6).bit_length()] += 1
+
+    def snapshot(self):
+        """Return a :py:class:`dict` with the count, total, mean and buckets.
+
+        Bucket keys are upper bounds in microseconds.
+        """
+        return dict(
+            count=self.count,
+            total=self.total,
+            mean=self.total / self.count if self.count else None,
+            buckets={2 ** b: n for b, n in sorted(self.buckets.items())},
+            )
+
+
+class Instrumentation:
+    """Counters and timings for a :class:`.Database`.
+
+    If given, *before* is called as ``before(method, args, kwargs)`` before
+    each instrumented method call, and *after* as ``after(method, args,
+    kwargs, seconds, error)`` after it, where *error* is the exception raised
+    by the method, or :py:data:`None`.
+    """
+
+    def __init__(self, before=None, after=None):
+        self.before = before
+        self.after = after
+        self.calls = defaultdict(Histogram)
+        self.sql = Histogram()
+        self.index_hits = 0
+        self.index_misses = 0
+
+    def call(self, name, f, args, kwargs):
+        """Call ``f(*args, **kwargs)``, recording it under *name*."""
+        if self.before is not None:
+            self.before(name, args, kwargs)
+
+        error = None
+        start = perf_counter()
+        try:
+            return f(*args, **kwargs)
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            elapsed = perf_counter() - start
+            self.calls[name].add(elapsed)
+            if self.after is not None:
+                self.after(name, args, kwargs, elapsed, error)
+
+    def snapshot(self):
+        """Return a :py:class:`dict` of the current statistics."""
+        lookups = self.index_hits + self.index_misses
+        return dict(
+            calls={name: h.snapshot() for name, h in
+                   sorted(self.calls.items())},
+            sql=self.sql.snapshot(),
+            index=dict(
+                hits=self.index_hits,
+                misses=self.index_misses,
+                hit_ratio=self.index_hits / lookups if lookups else None,
+                ),
+            )
+
+
+class Profile:
+    """Resource use of the stages of a process, such as :meth:`.admin.update`.
+
+    Each stage is recorded by :meth:`stage` as an entry in :attr:`stages`.
+    If *enabled* is :py:data:`False`, nothing is recorded.
+    """
+
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.stages = []
+
+    @contextmanager
+    def stage(self, name):
+        """Context manager to record a stage called *name*.
+
+        The context manager yields a :py:class:`dict` with the keys:
+
+        - 'name'.
+        - 'wall' and 'cpu': the wall and CPU (process) time in seconds.
+        - 'peak_memory': the peak memory allocated by Python during the stage,
+          in bytes, as measured by :py:mod:`tracemalloc`.
+        - 'records': :py:data:`None`; the code in the stage may set this to the
+          number of records processed.
+        """
+        record = OrderedDict([('name', name), ('wall', None), ('cpu', None),
+                              ('peak_memory', None), ('records', None)])
+
+        if not self.enabled:
+            yield record
+            return
+
+        tracing = tracemalloc.is_tracing()
+        if not tracing:
+            tracemalloc.start()
+        elif hasattr(tracemalloc, 'reset_peak'):  # Python 3.9 and later
+            tracemalloc.reset_peak()
+        base = tracemalloc.get_traced_memory()[0]
+
+        wall, cpu = perf_counter(), process_time()
+        try:
+            yield record
+        finally:
+            record['wall'] = perf_counter() - wall
+            record['cpu'] = process_time() - cpu
+            record['peak_memory'] = tracemalloc.get_traced_memory()[1] - base
+            if not tracing:
+                tracemalloc.stop()
+            self.stages.append(record)
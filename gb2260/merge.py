@@ -0,0 +1,182 @@
+"""Merge data sources on division codes.
+
+:meth:`merge` performs a sort-merge join of several sources, each an iterable
+of ``(code, row)`` pairs sorted by code, in a single pass. The value of each
+output field is chosen by a named policy from :data:`POLICIES`, which consults
+the sources in a declared order of precedence. The name of the source that
+supplied each field is recorded.
+"""
+from collections import OrderedDict
+
+__all__ = [
+    'POLICIES',
+    'Source',
+    'join',
+    'merge',
+    ]
+
+# Marker for a field that does not appear in a source's row
+_MISSING = object()
+
+
+def _first(candidates):
+    """Use the first non-empty value."""
+    for source, value in candidates:
+        if value is not None and value != '':
+            return source, value
+    return None, None
+
+
+def _present(candidates):
+    """Use the value from the first source with a row, even if empty."""
+    for source, value in candidates:
+        return source, value
+    return None, None
+
+
+#: Policies for choosing the value of a field. Each is called with a list of
+#: ``(source name, value)`` pairs, in order of precedence, and returns the pair
+#: that is used, or ``(None, None)``.
+POLICIES = {
+    'first': _first,
+    'present': _present,
+    }
+
+
+class Source:
+    """A source of data for :meth:`merge`.
+
+    *name* identifies the source in policies and provenance records. *rows* is
+    an iterable of ``(code, row)`` pairs, sorted by code, where each row is a
+    :py:class:`dict`. *fields* maps output field names to either a key in the
+    row, or a callable that receives the row and returns the value; by
+    default, output fields are read from the row keys of the same name.
+
+    If given, *accept* is called as ``accept(base, row)``, with the row from
+    the base source, for every row of this source. It returns
+    :py:data:`None` if the row may be used, or else a string giving the
+    reason it is rejected.
+    """
+
+    def __init__(self, name, rows, fields=None, accept=None):
+        self.name = name
+        self.rows = rows
+        self.fields = {} if fields is None else fields
+        self.accept = accept
+
+    def get(self, field, row):
+        """Return the value of output *field* from *row*."""
+        key = self.fields.get(field, field)
+        if callable(key):
+            return key(row)
+        return row.get(key, _MISSING)
+
+
+def join(*sources):
+    """Sort-merge join iterables of ``(code, row)`` pairs on code.
+
+    Each of *sources* must be sorted by code. Yields ``(code, rows)`` for each
+    code in any of the sources, in order, where *rows* is a list with one
+    entry per source: its row for *code*, or :py:data:`None`. If a source has
+    several rows with the same code, the last one is used.
+
+    Raises :py:class:`ValueError` if a source is not sorted.
+    """
+    iters = [iter(s) for s in sources]
+    heads = [next(it, None) for it in iters]
+
+    while True:
+        try:
+            code = min(head[0] for head in heads if head is not None)
+        except ValueError:
+            # All sources exhausted
+            return
+
+        rows = []
+        for i, it in enumerate(iters):
+            row = None
+            while heads[i] is not None and heads[i][0] == code:
+                row = heads[i][1]
+                heads[i] = next(it, None)
+                if heads[i] is not None and heads[i][0] < code:
+                    raise ValueError('source %d is not sorted: %d after %d' %
+                                     (i, heads[i][0], code))
+            rows.append(row)
+
+        yield code, rows
+
+
+def merge(base, sources, fields):
+    """Merge *sources* into the codes of *base*.
+
+    *base* and the entries of *sources* are :class:`Source` objects. Only
+    codes that appear in *base* are included in the result. *fields* is an
+    ordered mapping from output field names to ``(policy, names)``, where
+    *policy* is a key of :data:`POLICIES` and *names* is a sequence of source
+    names, in order of precedence.
+
+    Yields a tuple ``(entry, provenance, notes)`` for each code, in order:
+
+    - *entry* is a :py:class:`dict` with the key 'code' and every field in
+      *fields*.
+    - *provenance* maps field names to the name of the source that supplied
+      the value. Fields that no source supplied are omitted.
+    - *notes* is a list of ``(source name, reason)`` for sources that were not
+      used for this code; *reason* is 'missing' if the source has no row.
+    """
+    all_sources = [base] + list(sources)
+    by_name = OrderedDict((s.name, s) for s in all_sources)
+
+    # Check the field specifications before starting
+    for field, (policy, names) in fields.items():
+        if policy not in POLICIES:
+            raise ValueError('unknown policy %r for field %s' % (policy,
+                                                                 field))
+        for name in names:
+            if name not in by_name:
+                raise ValueError('unknown source %r for field %s' % (name,
+                                                                     field))
+
+    for code, rows in join(*[s.rows for s in all_sources]):
+        base_row = rows[0]
+        if base_row is None:
+            continue
+
+        # Rows that may be used, by source name
+        accepted = {}
+        notes = []
+
+        for source, row in zip(all_sources, rows):
+            if row is None:
+                if source is not base:
+                    notes.append((source.name, 'missing'))
+                continue
+
+            reason = None
+            if source.accept is not None and source is not base:
+                reason = source.accept(base_row, row)
+
+            if reason is None:
+                accepted[source.name] = row
+            else:
+                notes.append((source.name, reason))
+
+        entry = {'code': code}
+        provenance = {}
+
+        for field, (policy, names) in fields.items():
+            candidates = []
+            for name in names:
+                row = accepted.get(name)
+                if row is None:
+                    # No usable row from this source
+                    continue
+                value = by_name[name].get(field, row)
+                if value is not _MISSING:
+                    candidates.append((name, value))
+
+            supplier, entry[field] = POLICIES[policy](candidates)
+            if supplier is not None:
+                provenance[field] = supplier
+
+        yield entry, provenance, notes
@@ -0,0 +1,228 @@
+"""Normalized forms of division names, for the indexes used by searches."""
+import re
+import unicodedata
+
+import jianfan
+
+__all__ = [
+    'SHORT_FORMS',
+    'SIMPLIFIED_PHRASES',
+    'SUFFIXES',
+    'TRADITIONAL_PHRASES',
+    'ZH_SUFFIXES',
+    'roman_key',
+    'short_roman',
+    'short_zh',
+    'simplified',
+    'traditional',
+    'traditional_forms',
+    ]
+
+#: Suffixes for types of divisions, in romanized names.
+SUFFIXES = [
+    'kuangqu',    # 矿区, mining area
+    'qi',         # 旗, banner
+    'qu',         # 区, area
+    'shi',        # 市, city
+    'xian',       # 县, county
+    'zizhixian',  # 自治县, autonomous county
+    'zizhizhou',  # 自治州, autonomous state
+    ]
+
+#: Suffixes for types of divisions, in Chinese names.
+ZH_SUFFIXES = [
+    '特别行政区',  # special administrative region
+    '自治区',      # autonomous region
+    '自治州',      # autonomous prefecture
+    '自治县',      # autonomous county
+    '自治旗',      # autonomous banner
+    '地区',        # prefecture
+    '林区',        # forestry area
+    '矿区',        # mining area
+    '新区',        # new area
+    '省',          # province
+    '市',          # city
+    '县',          # county
+    '区',          # area, district
+    '旗',          # banner
+    '盟',          # league
+    ]
+
+# Names of ethnic groups in the names of autonomous divisions, e.g.
+# 恩施土家族苗族自治州. 各 is from 各族, "all ethnicities".
+_ETHNIC_GROUPS = (
+    '保安 布朗 布依 朝鲜 达斡尔 东乡 侗 独龙 鄂伦春 鄂温克 仡佬 各 哈尼 哈萨克 回 '
+    '景颇 柯尔克孜 拉祜 黎 傈僳 满 毛南 蒙古 苗 仫佬 纳西 怒 普米 羌 撒拉 畲 水 '
+    '塔吉克 土 土家 佤 维吾尔 锡伯 瑶 彝 裕固 藏 壮 傣 白').split()
+
+_ethnic_re = re.compile('(?:%s)族?$' % '|'.join(
+    sorted(_ETHNIC_GROUPS, key=len, reverse=True)))
+
+# Prefix naming the parent division in romanized names, e.g. 'Beijing: '
+_roman_prefix_re = re.compile('^[^:]*: ')
+
+# Suffixes in romanized names, longest first
+_roman_suffixes = sorted(SUFFIXES, key=len, reverse=True)
+
+# Characters removed from romanized names by roman_key()
+_roman_remove = str.maketrans('', '', " '\u2019-:")
+
+
+#: Traditional forms of simplified characters and phrases in names, where
+#: these differ from the conversion of single characters by
+#: :func:`jianfan.jtof`.
+TRADITIONAL_PHRASES = {
+    '斗门': '斗門',
+    '江干': '江干',
+    '余干': '餘干',
+    '库尔干': '庫爾干',
+    '沈阳': '瀋陽',
+    '沈河': '瀋河',
+    '沈北': '瀋北',
+    '钟祥': '鍾祥',
+    '钟山': '鍾山',
+    '岱岳': '岱嶽',
+    '南岳': '南嶽',
+    '岳': '岳',
+    '咸': '咸',
+    '志': '志',
+    '范': '范',
+    '里': '里',
+    }
+
+#: Simplified forms of traditional characters and phrases in names, where these
+#: differ from the conversion of single characters by :func:`jianfan.ftoj`.
+#: The reverse of the phrases in :data:`TRADITIONAL_PHRASES` are also used.
+SIMPLIFIED_PHRASES = {
+    '寧': '宁',
+    '絳': '绛',
+    '墊': '垫',
+    '沈': '沈',
+    '楞': '楞',
+    '叠': '叠',
+    }
+
+_SIMPLIFIED_PHRASES = dict(SIMPLIFIED_PHRASES)
+_SIMPLIFIED_PHRASES.update((v, k) for k, v in TRADITIONAL_PHRASES.items() if
+                           len(v) > 1)
+
+
+def _phrase_re(phrases):
+    return re.compile('|'.join(sorted(phrases, key=len, reverse=True)))
+
+
+_traditional_re = _phrase_re(TRADITIONAL_PHRASES)
+_simplified_re = _phrase_re(_SIMPLIFIED_PHRASES)
+
+
+def _convert(name, phrases, pattern, convert):
+    """Convert *name* using *phrases* where *pattern* matches, else *convert*.
+    """
+    parts = []
+    pos = 0
+    for match in pattern.finditer(name):
+        parts.append(convert(name[pos:match.start()]))
+        parts.append(phrases[match.group()])
+        pos = match.end()
+    parts.append(convert(name[pos:]))
+    return ''.join(parts)
+
+
+def traditional(name):
+    """Return the traditional-character form of the Chinese *name*.
+
+    >>> traditional('广东省')
+    '廣東省'
+    >>> traditional('沈阳市')
+    '瀋陽市'
+    """
+    return _convert(name, TRADITIONAL_PHRASES, _traditional_re,
+                    jianfan.jtof)
+
+
+def traditional_forms(name):
+    """Return the set of possible traditional forms of the Chinese *name*.
+
+    These are the result of :func:`traditional`, and the conversion of single
+    characters by :func:`jianfan.jtof`, which is sometimes used instead.
+    """
+    return {traditional(name), jianfan.jtof(name)}
+
+
+def simplified(name):
+    """Return the simplified-character form of the Chinese *name*.
+
+    The inverse of :func:`traditional`. Names already in simplified
+    characters are unchanged.
+    """
+    return _convert(name, _SIMPLIFIED_PHRASES, _simplified_re,
+                    jianfan.ftoj)
+
+
+def short_zh(name):
+    """Return the short form of the Chinese *name*, without its suffix.
+
+    >>> short_zh('海淀区')
+    '海淀'
+    >>> short_zh('恩施土家族苗族自治州')
+    '恩施'
+
+    At least two characters are kept, so e.g. '城区' is not shortened.
+    """
+    for suffix in ZH_SUFFIXES:
+        if name.endswith(suffix) and len(name) - len(suffix) >= 2:
+            short = name[:-len(suffix)]
+            while suffix.startswith('自治'):
+                # Remove the names of ethnic groups, one at a time
+                match = _ethnic_re.search(short)
+                if match is None or match.start() < 2:
+                    break
+                short = short[:match.start()]
+            return short
+    return name
+
+
+def roman_key(name):
+    """Return a normalized form of the romanized *name*.
+
+    The name is case-folded, and tone marks, spaces, apostrophes, hyphens and
+    colons are removed:
+
+    >>> roman_key("Guǎng Zhōu")
+    'guangzhou'
+    >>> roman_key("Xi'an")
+    'xian'
+    """
+    name = unicodedata.normalize('NFD', name.casefold())
+    name = ''.join(c for c in name if not unicodedata.combining(c))
+    return name.translate(_roman_remove)
+
+
+def short_roman(name):
+    """Return the short form of the romanized *name*.
+
+    The prefix naming the parent division, and a suffix from
+    :data:`SUFFIXES` (with or without a space) are removed, and the result
+    is normalized by :func:`roman_key`:
+
+    >>> short_roman('Beijing: Haidian qu')
+    'haidian'
+    >>> short_roman('Guangzhoushi')
+    'guangzhou'
+
+    At least two letters are kept.
+    """
+    key = roman_key(_roman_prefix_re.sub('', name))
+    for suffix in _roman_suffixes:
+        if key.endswith(suffix) and len(key) - len(suffix) >= 2:
+            return key[:-len(suffix)]
+    return key
+
+
+#: Functions giving the short forms of names in each field, for
+#: :meth:`.Database.search` with ``short=True``.
+SHORT_FORMS = {
+    'name_zh': short_zh,
+    'name_pinyin': short_roman,
+    'name_en': short_roman,
+    }
@@ -0,0 +1,313 @@
+"""A local HTTP service for division lookups.
+
+Run with ``python -m gb2260 serve``. Every endpoint accepts a GET request with
+parameters in the query string, and returns JSON::
+
+  GET /get?code=110108
+  GET /get?name_en=Guangzhou
+  GET /search?name_zh=市辖区&within=110000
+  GET /stack?code=110108
+  GET /parent?code=110108&level=1
+  GET /within?a=331024&b=330000
+  GET /isolike?code=130100
+  GET /from_isolike?value=CN-HE-SJW
+
+Divisions are returned as objects with the fields of the :doc:`data model
+<data-model>`. Failed lookups give status 404, and invalid parameters status
+400, with a body like ``{"error": "InvalidCodeError", "message": "990000"}``;
+other errors give status 500.
+
+A POST request to the same paths performs a batch of lookups: the body is a
+JSON array of objects, each containing the parameters of one lookup, and the
+response is an array of the same length, with either ``{"result": …}`` or an
+error object for each lookup.
+
+``GET /stats`` reports the number of requests served, the throughput, and the
+statistics of the database (see :meth:`.Database.stats`).
+
+Connections are kept alive, as usual for HTTP/1.1.
+"""
+import asyncio
+import json
+import logging
+from time import monotonic
+from urllib.parse import parse_qsl, urlsplit
+
+import gb2260
+from .aio import AsyncDatabase
+from .database import COLUMNS, Division
+
+__all__ = [
+    'Server',
+    'serve',
+    ]
+
+log = logging.getLogger(__name__)
+
+try:
+    _current_task = asyncio.current_task
+except AttributeError:  # Python < 3.7
+    _current_task = asyncio.Task.current_task
+
+_REASONS = {
+    200: 'OK',
+    400: 'Bad Request',
+    404: 'Not Found',
+    405: 'Method Not Allowed',
+    500: 'Internal Server Error',
+    }
+
+
+def _to_json(obj):
+    """Convert *obj*, possibly containing Divisions, for :py:mod:`json`."""
+    if isinstance(obj, Division):
+        return {k: obj[k] for k in COLUMNS}
+    elif isinstance(obj, (list, tuple)):
+        return [_to_json(o) for o in obj]
+    return obj
+
+
+def _error(exc):
+    """Return a JSON error object for *exc*."""
+    return {'error': exc.__class__.__name__,
+            'message': ' '.join(map(str, exc.args))}
+
+
+def _int(params, name, default=KeyError):
+    """Return parameter *name* from *params* as an :py:class:`int`."""
+    try:
+        return int(params.pop(name))
+    except KeyError:
+        if default is KeyError:
+            raise ValueError('missing parameter: %s' % name)
+        return default
+
+
+class Server:
+    """HTTP server for lookups in *db*, a :class:`.Database`."""
+
+    def __init__(self, db=None):
+        self.db = AsyncDatabase(gb2260.divisions if db is None else db)
+        self.requests = 0
+        self.started = monotonic()
+        self._server = None
+        self._report = None
+        self._connections = set()
+        self._endpoints = {
+            'get': self.get,
+            'search': self.search,
+            'stack': self.stack,
+            'parent': self.parent,
+            'within': self.within,
+            'isolike': self.isolike,
+            'from_isolike': self.from_isolike,
+            }
+
+    # Endpoints. Each receives a dict of parameters, and returns a result
+    # that can be serialized by _to_json().
+
+    async def get(self, params):
+        if 'code' in params:
+            return await self.db.get(_int(params, 'code'), **params)
+        elif len(params) != 1:
+            raise ValueError('expected one parameter')
+        elif next(iter(params)) not in COLUMNS:
+            raise ValueError('invalid field name: %s' % next(iter(params)))
+        return await self.db.search(**params)
+
+    async def search(self, params):
+        if 'within' in params:
+            params['within'] = _int(params, 'within')
+        level = params.get('level')
+        if isinstance(level, str) and level.isdigit():
+            params['level'] = int(level)
+        for flag in ('partial', 'short'):
+            value = params.get(flag)
+            if isinstance(value, str):
+                params[flag] = value.lower() in ('1', 'true', 'yes')
+        return await self.db.search(**params)
+
+    async def stack(self, params):
+        return await self.db.stack(_int(params, 'code'))
+
+    async def parent(self, params):
+        return await self.db.run(self.db.db.parent, _int(params, 'code'),
+                                 _int(params, 'level', None))
+
+    async def within(self, params):
+        return gb2260.within(_int(params, 'a'), _int(params, 'b'))
+
+    async def isolike(self, params):
+        kwargs = {'prefix': params['prefix']} if 'prefix' in params else {}
+        return await self.db.run(self.db.db.isolike, _int(params, 'code'),
+                                 **kwargs)
+
+    async def from_isolike(self, params):
+        return await self.db.run(self.db.db.from_isolike, params.pop('value'),
+                                 **params)
+
+    def stats(self):
+        """Return statistics on requests served and on the database."""
+        uptime = monotonic() - self.started
+        return dict(
+            requests=self.requests,
+            uptime=uptime,
+            requests_per_second=self.requests / uptime if uptime else None,
+            database=self.db.db.stats(),
+            )
+
+    async def _call(self, endpoint, params):
+        """Call *endpoint*; return an HTTP status and the JSON result."""
+        try:
+            return 200, {'result': _to_json(await endpoint(dict(params)))}
+        except LookupError as e:
+            return 404, _error(e)
+        except (TypeError, ValueError) as e:
+            return 400, _error(e)
+        except Exception as e:
+            log.exception('error in %s(%s)', endpoint.__name__, params)
+            return 500, _error(e)
+
+    async def dispatch(self, method, target, body):
+        """Handle a request; return an HTTP status and the JSON response."""
+        url = urlsplit(target)
+        name = url.path.strip('/')
+
+        if name == 'stats' and method == 'GET':
+            return 200, self.stats()
+
+        try:
+            endpoint = self._endpoints[name]
+        except KeyError:
+            return 404, {'error': 'NotFound', 'message': url.path}
+
+        if method == 'GET':
+            status, result = await self._call(endpoint,
+                                              parse_qsl(url.query))
+            return status, result.get('result', result)
+        elif method == 'POST':
+            try:
+                batch = json.loads(body.decode('utf-8'))
+                assert isinstance(batch, list)
+            except (AssertionError, ValueError):
+                return 400, {'error': 'ValueError',
+                             'message': 'body must be a JSON array'}
+            result = []
+            for params in batch:
+                result.append((await self._call(endpoint, params))[1])
+            return 200, result
+        else:
+            return 405, {'error': 'MethodNotAllowed', 'message': method}
+
+    async def handle(self, reader, writer):
+        """Handle the requests on one connection."""
+        task = _current_task()
+        self._connections.add(task)
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+
+                try:
+                    method, target, version = request_line.decode(
+                        'latin-1').split()
+                    headers = {}
+                    while True:
+                        line = await reader.readline()
+                        if line.strip() == b'':
+                            break
+                        key, value = line.decode('latin-1').split(':', 1)
+                        headers[key.strip().lower()] = value.strip()
+                    body = await reader.readexactly(
+                        int(headers.get('content-length', 0)))
+                except ValueError:
+                    # Malformed request; respond, then close the connection
+                    status, result = 400, {'error': 'BadRequest',
+                                           'message': 'malformed request'}
+                    version, headers = 'HTTP/1.0', {'connection': 'close'}
+                else:
+                    status, result = await self.dispatch(method, target, body)
+
+                self.requests += 1
+
+                connection = headers.get('connection', '').lower()
+                keep_alive = connection == 'keep-alive' or (
+                    version == 'HTTP/1.1' and connection != 'close')
+
+                data = json.dumps(result, ensure_ascii=False).encode('utf-8')
+                writer.write((
+                    'HTTP/1.1 %d %s\r\n'
+                    'Content-Type: application/json; charset=utf-8\r\n'
+                    'Content-Length: %d\r\n'
+                    'Connection: %s\r\n'
+                    '\r\n' % (status, _REASONS[status], len(data),
+                              'keep-alive' if keep_alive else 'close')
+                    ).encode('latin-1') + data)
+                await writer.drain()
+
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            self._connections.discard(task)
+            writer.close()
+
+    async def start(self, host='127.0.0.1', port=2260):
+        """Start listening on *host* and *port*."""
+        self._server = await asyncio.start_server(self.handle, host, port)
+        self.started = monotonic()
+        return self._server
+
+    def report(self, interval):
+        """Log throughput every *interval* seconds, until :meth:`close`."""
+        async def report():
+            while True:
+                await asyncio.sleep(interval)
+                stats = self.stats()
+                log.info('%d requests, %.1f per second', stats['requests'],
+                         stats['requests_per_second'])
+
+        self._report = asyncio.ensure_future(report())
+
+    async def close(self):
+        """Stop the server."""
+        if self._report is not None:
+            self._report.cancel()
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+        # Close open connections
+        for task in list(self._connections):
+            task.cancel()
+        await asyncio.gather(*self._connections, return_exceptions=True)
+        self.db.close()
+
+
+def serve(host='127.0.0.1', port=2260, report=60):
+    """Run a :class:`Server` on *host* and *port* until interrupted.
+
+    Throughput is logged every *report* seconds; use ``report=0`` to disable.
+    """
+    logging.basicConfig(format='%(name)s: %(message)s', level=logging.INFO)
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    server = Server()
+
+    try:
+        sockets = loop.run_until_complete(server.start(host, port)).sockets
+        log.info('serving on %s', ', '.join(
+            '%s:%d' % s.getsockname()[:2] for s in sockets))
+        if report:
+            server.report(report)
+        loop.run_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        loop.run_until_complete(server.close())
+        stats = server.stats()
+        log.info('served %d requests, %.1f per second', stats['requests'],
+                 stats['requests_per_second'])
+        loop.close()
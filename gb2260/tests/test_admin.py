@@ -1,11 +1,23 @@
 import glob
 import os
 from os.path import basename, join
+import sqlite3
 
 import pytest
 
 from gb2260.database import DATA_DIR
-from gb2260.admin import URLS, load_csv, parse_html, update, refresh_cache
+from gb2260.instrument import Profile
+from gb2260.admin import (
+    URLS,
+    iter_csv,
+    load_columns,
+    load_csv,
+    parse_html,
+    refresh_cache,
+    update,
+    write_arrow,
+    write_sqlite,
+    )
 
 num_entries = {
     '2012': 3507,
@@ -37,6 +49,122 @@ def test_load_csv(fn):
     load_csv(base, **kwargs)
 
 
+def test_iter_csv():
+    rows = iter_csv('unified')
+    row = next(rows)
+    assert row['code'] == 110000
+    assert row['name_zh'] == '北京市'
+    assert row['latitude'] == 39.9081726
+    assert row['alpha'] == 'BJ'
+    row = next(rows)
+    # Empty values in typed fields are None; others are left as str
+    assert row['alpha'] is None
+    assert row['latitude'] is None
+    assert row['name_en'] == 'Beijing city area'
+    rows.close()
+
+    # Filter on the untyped row
+    rows = list(iter_csv('citas', filter=lambda r: r['todate'] == '19941231'))
+    assert all(row['todate'] == '19941231' for row in rows)
+
+
+def test_load_columns():
+    columns = load_columns('unified')
+    assert len(columns['code']) == 3514
+    assert all(len(c) == 3514 for c in columns.values())
+    assert columns['code'][:2] == [110000, 110100]
+    assert columns['level'][:2] == [1, 2]
+    assert columns['latitude'][1] is None
+
+    # Custom schema
+    columns = load_columns('latest', schema={'level': int})
+    assert columns['code'][0] == '110000'
+    assert columns['level'][0] == 1
+
+
+def test_profile():
+    prof = Profile()
+    with prof.stage('load') as stage:
+        stage['records'] = len(load_csv('unified'))
+    with pytest.raises(ValueError):
+        with prof.stage('fail'):
+            raise ValueError
+
+    assert [s['name'] for s in prof.stages] == ['load', 'fail']
+    load = prof.stages[0]
+    assert load['records'] == 3514
+    assert load['wall'] > 0 and load['cpu'] > 0 and load['peak_memory'] > 0
+
+    # Disabled
+    prof = Profile(enabled=False)
+    with prof.stage('load'):
+        pass
+    assert prof.stages == []
+
+
+def test_write_sqlite(tmpdir):
+    data = load_csv('unified', keep_key=True)
+    write_sqlite('unified', data, target=str(tmpdir))
+
+    # Only the finished database remains in the target directory
+    assert [p.basename for p in tmpdir.listdir()] == ['unified.db']
+
+    # with the usual permissions
+    umask = os.umask(0)
+    os.umask(umask)
+    assert os.stat(str(tmpdir.join('unified.db'))).st_mode & 0o777 == \
+        0o666 & ~umask
+
+    conn = sqlite3.connect(str(tmpdir.join('unified.db')))
+    assert conn.execute('SELECT count(*) FROM codes').fetchone()[0] == \
+        len(data)
+    # code is an alias for the rowid
+    assert conn.execute('SELECT rowid FROM codes WHERE code = 110108') \
+        .fetchone()[0] == 110108
+
+    # Secondary indexes exist and have been analyzed
+    indexes = {row[0] for row in conn.execute(
+        "SELECT name FROM sqlite_master WHERE type = 'index'")}
+    assert 'codes_name_zh' in indexes
+    assert conn.execute('SELECT count(*) FROM sqlite_stat1').fetchone()[0]
+
+    # The data version is stored
+    version = conn.execute('PRAGMA user_version').fetchone()[0]
+    assert version > 0
+    conn.close()
+
+    # Rewriting replaces the existing file; the same data has the same version
+    write_sqlite('unified', data, target=str(tmpdir))
+    assert [p.basename for p in tmpdir.listdir()] == ['unified.db']
+    conn = sqlite3.connect(str(tmpdir.join('unified.db')))
+    assert conn.execute('PRAGMA user_version').fetchone()[0] == version
+    conn.close()
+
+
+def test_write_arrow(tmpdir):
+    pa = pytest.importorskip('pyarrow')
+    data = load_csv('unified', keep_key=True)
+    write_arrow('unified', data, target=str(tmpdir))
+    write_sqlite('unified', data, target=str(tmpdir))
+    assert sorted(p.basename for p in tmpdir.listdir()) == \
+        ['unified.arrow', 'unified.db']
+    umask = os.umask(0)
+    os.umask(umask)
+    assert os.stat(str(tmpdir.join('unified.arrow'))).st_mode & 0o777 == \
+        0o666 & ~umask
+
+    table = pa.ipc.open_file(pa.memory_map(
+        str(tmpdir.join('unified.arrow')))).read_all()
+    assert table.num_rows == len(data)
+    assert table.column_names[:2] == ['code', 'name_zh']
+
+    # The same version as the sqlite3 database
+    conn = sqlite3.connect(str(tmpdir.join('unified.db')))
+    version = conn.execute('PRAGMA user_version').fetchone()[0]
+    assert table.schema.metadata[b'version'] == str(version).encode()
+    conn.close()
+
+
 @pytest.mark.skipif(os.environ.get('TRAVIS', '') == 'true',
                     reason="Don't spam the government's servers")
 def test_refresh_cache(tmpdir):
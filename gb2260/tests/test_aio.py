@@ -0,0 +1,89 @@
+import asyncio
+
+import pytest
+
+from gb2260 import InvalidCodeError, RegionKeyError
+from gb2260.aio import AsyncDatabase
+
+
+@pytest.fixture
+def run():
+    loop = asyncio.new_event_loop()
+    yield loop.run_until_complete
+    loop.close()
+
+
+@pytest.fixture
+def db():
+    db = AsyncDatabase()
+    yield db
+    db.close()
+
+
+def test_get(run, db):
+    div = run(db.get(110108))
+    assert div.name_en == 'Haidian'
+    # Returned from memory
+    assert run(db.get('110108')) is div
+
+    assert run(db.get(name_en='Guangzhou')) == 440100
+
+    with pytest.raises(InvalidCodeError):
+        run(db.get(990000))
+
+
+def test_lookup_search(run, db):
+    assert run(db.lookup('Guangzhou')) == 440100
+    assert run(db.search(name_zh='海淀区')) == 110108
+    # Cached
+    assert run(db.search(name_zh='海淀区')) == 110108
+    assert db.db.cache_info().hits == 1
+
+    with pytest.raises(RegionKeyError):
+        run(db.search(name_zh='bogus'))
+    # Cached failure, raised without a query
+    with pytest.raises(RegionKeyError):
+        run(db.search(name_zh='bogus'))
+    assert db.db.cache_info()[:2] == (2, 2)
+
+    result = run(db.search_ranked(name_zh='朝阳', context=dict(level=2)))
+    assert result[0].division == 211300
+
+
+def test_stack(run, db):
+    assert run(db.stack(110101)) == (110000, 110100, 110101)
+    assert run(db.stack(110101)) == (110000, 110100, 110101)
+
+
+def test_many(run, db):
+    # Before and after the database is loaded
+    assert run(db.lookup_many(['Guangzhou', 'bogus'])) == [440100, None]
+
+    assert run(db.get_many([110108, 440100])) == [110108, 440100]
+
+    result = run(db.get_many([110108, 990000], return_exceptions=True))
+    assert result[0] == 110108
+    assert isinstance(result[1], InvalidCodeError)
+
+    with pytest.raises(InvalidCodeError):
+        run(db.get_many([990000]))
+
+    assert run(db.lookup_many(['Guangzhou', '海淀区', 'bogus'])) == \
+        [440100, 110108, None]
+    assert run(db.search_many([dict(name_zh='市辖区', within=110000),
+                               dict(name_en='Hainan', level=1)])) == \
+        [110100, 460000]
+
+
+def test_concurrent(run, db):
+    async def main():
+        return await asyncio.gather(*[db.get(code) for code in
+                                      (110000, 110100, 110108, 440100) * 10])
+    assert len(run(main())) == 40
+
+
+def test_context(run):
+    async def main():
+        async with AsyncDatabase() as db:
+            return await db.get(110108)
+    assert run(main()) == 110108
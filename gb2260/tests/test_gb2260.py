@@ -1,14 +1,23 @@
+import os
+import pickle
+from threading import Thread
+
 import pytest
 
 from gb2260 import (
+    Database,
     divisions,
+    from_isolike,
+    is_valid,
     isolike,
     level,
     parent,
+    parent_many,
     split,
     within,
     AmbiguousRegionError,
-    InvalidCodeError
+    InvalidCodeError,
+    RegionKeyError,
     )
 
 
@@ -28,11 +37,241 @@ def test_all_at():
         divisions.all_at_level(0)
 
 
+def test_iter():
+    d = divisions
+    codes = [div.code for div in d]
+    assert codes == sorted(codes)
+    assert len(codes) == len(d)
+
+    assert [div.code for div in d.iter(within=110100)][:3] == \
+        [110100, 110101, 110102]
+    assert all(within(div.code, 110000) for div in d.iter(within='110000'))
+    assert [div.code for div in d.iter(level=2, within=110000)] == \
+        [110100, 110200]
+    assert list(d.iter(within=110108)) == [110108]
+    assert list(d.iter(within=990000)) == []
+    assert sum(1 for div in d.iter(level=1)) == 34
+
+    with pytest.raises(ValueError):
+        d.iter(level=4)
+
+
+def test_rollup():
+    codes = [110101, 110108, 120101, 110000, 990101]
+    values = [1, 2, 4, 8, 16]
+    r = divisions.rollup(codes, values, levels=(1, 2, 3))
+    assert r.aggregates[1] == {
+        110000: dict(count=3, sum=11, mean=11 / 3, min=1, max=8),
+        120000: dict(count=1, sum=4, mean=4, min=4, max=4),
+        }
+    # Codes above a level are not aggregated at that level
+    assert list(r.aggregates[2]) == [110100, 120100]
+    assert r.aggregates[2][110100]['sum'] == 3
+    assert r.aggregates[3][110108]['count'] == 1
+    assert r.unmatched == {1: [990101], 2: [990101], 3: [990101]}
+
+    # A mapping, and selected statistics
+    r = divisions.rollup(dict(zip(codes, values)), levels=[1],
+                         stats=['sum'])
+    assert r.aggregates == {1: {110000: dict(sum=11), 120000: dict(sum=4)}}
+
+    with pytest.raises(ValueError):
+        divisions.rollup(codes, values, levels=[0])
+    with pytest.raises(ValueError):
+        divisions.rollup(codes, values, stats=['median'])
+    with pytest.raises(ValueError):
+        divisions.rollup(codes, values[:2])
+
+
+def test_rollup_numpy():
+    np = pytest.importorskip('numpy')
+    codes = [110101, 110108, 120101, 110000, 990101]
+    values = [1, 2, 4, 8, 16]
+    expected = divisions.rollup(codes, values, levels=(1, 2, 3))
+    assert divisions.rollup(np.array(codes), np.array(values),
+                            levels=(1, 2, 3)) == expected
+
+
+def test_in_bbox():
+    d = divisions
+    result = d.in_bbox(39.8, 116.2, 40.1, 116.5)
+    assert [div.code for div in result][:3] == [110000, 110101, 110102]
+    assert all(39.8 <= div.latitude <= 40.1 for div in result)
+    assert d.in_bbox(39.8, 116.2, 40.1, 116.5, level=1) == [110000]
+    assert d.in_bbox(-10, -10, 10, 10) == []
+
+    # Divisions without coordinates are omitted
+    everywhere = d.in_bbox(-90, -180, 90, 180)
+    assert len(everywhere) == d.summary()['coverage']['latitude']
+
+    with pytest.raises(ValueError):
+        d.in_bbox(40.1, 116.2, 39.8, 116.5)
+
+
+def test_within_radius():
+    d = divisions
+    result = d.within_radius(39.9351199, 116.4093947, 30, level=3)
+    # Nearest first
+    assert result[0] == 110101
+    assert 110108 in result
+    assert 120101 not in result
+    assert 120101 in d.within_radius(39.9351199, 116.4093947, 150)
+    assert d.within_radius(39.9, 116.4, 150, within=120000)[0].code // \
+        10000 == 12
+    assert len(d.within_radius(0, 0, 30000)) == \
+        d.summary()['coverage']['latitude']
+
+    with pytest.raises(ValueError):
+        d.within_radius(39.9, 116.4, -1)
+
+
+def test_distances(tmpdir):
+    np = pytest.importorskip('numpy')
+    d = divisions
+
+    codes, matrix = d.distances(within=110000, level=3)
+    assert codes[0] == 110101
+    assert matrix.shape == (len(codes), len(codes))
+    assert np.allclose(matrix, matrix.T)
+    assert (matrix.diagonal() == 0).all()
+    assert 3 < matrix[0, 1] < 5
+
+    # Condensed form
+    condensed = d.distances(within=110000, level=3, condensed=True).distances
+    assert condensed.tolist() == matrix[np.triu_indices(len(codes), 1)] \
+        .tolist()
+
+    # Explicit codes; a division without coordinates
+    codes, m = d.distances([110108, 110101, 110100])
+    assert m[0, 1] == m[1, 0] > 0
+    assert np.isnan(m[2]).all()
+
+    # Blockwise
+    blocks = list(d.distance_blocks(within=110000, level=3, block_size=5))
+    assert [start for start, block in blocks] == [0, 5, 10, 15]
+    assert np.array_equal(np.vstack([b for s, b in blocks]), matrix)
+
+    # Cached
+    for i in range(2):
+        cached = d.distances(within=110000, level=3, cache_dir=str(tmpdir))
+        assert np.allclose(cached.distances, matrix)
+    assert len(tmpdir.listdir()) == 1
+    cached = d.distances(within=110000, level=3, condensed=True,
+                         cache_dir=str(tmpdir))
+    assert np.allclose(cached.distances, condensed)
+
+    # The cache file has the usual permissions
+    umask = os.umask(0)
+    os.umask(umask)
+    assert os.stat(str(tmpdir.listdir()[0])).st_mode & 0o777 == \
+        0o666 & ~umask
+    with pytest.raises(ValueError):
+        d.distances([110000], level=3, cache_dir=str(tmpdir))
+
+
+def test_summary():
+    summary = divisions.summary()
+    assert summary['count'] == len(divisions)
+    assert summary['levels'] == {1: 34, 2: 346, 3: 3134}
+    assert summary['children'][110000] == 2
+    assert summary['children'][110108] == 0
+    assert summary['coverage']['name_zh'] == len(divisions)
+    assert summary['coverage']['alpha'] < len(divisions)
+    # Empty names are not counted
+    assert summary['coverage']['name_en'] < len(divisions)
+    assert divisions.summary() is summary
+
+
 def test_isolike():
     assert isolike(130100) == 'CN-HE-SJW'
     assert isolike(130000) == 'CN-HE'
     with pytest.raises(InvalidCodeError):
         isolike(542621)
+    # No alpha code at level 3
+    with pytest.raises(ValueError):
+        isolike(110108)
+
+    assert divisions.isolike_many([130100, 110108, 990000, 'x', None],
+                                  prefix='') == ['HE-SJW'] + [None] * 4
+
+
+def test_from_isolike():
+    assert from_isolike('CN-HE-SJW') == 130100
+    assert from_isolike('cn-he-sjw') == 130100
+    assert from_isolike('HE') == 130000
+    assert from_isolike(isolike(440100)) == 440100
+    with pytest.raises(RegionKeyError):
+        from_isolike('CN-XX')
+
+    with pytest.raises(TypeError):
+        from_isolike(None)
+
+    assert divisions.from_isolike_many(['CN-BJ', 'CN-XX', 1]) == \
+        [110000, None, None]
+
+
+def test_is_valid():
+    assert is_valid(110108)
+    assert is_valid('110108')
+    assert not is_valid(990000)
+    assert not is_valid(-1)
+    assert not is_valid(1000000)
+    assert not is_valid('foo')
+    assert is_valid(110108.0)
+    assert not is_valid(110108.9)
+    assert not is_valid(float('nan'))
+    assert not is_valid(float('inf'))
+
+    assert divisions.valid_mask([110108, 990000, '110100', None]) == \
+        bytearray([1, 0, 1, 0])
+    assert divisions.valid_mask([110108, 110108.9]) == bytearray([1, 0])
+
+
+def test_valid_mask_numpy():
+    np = pytest.importorskip('numpy')
+    codes = np.array([110108, 990000, -1, 2000000, 440100])
+    assert divisions.valid_mask(codes).tolist() == \
+        [True, False, False, False, True]
+
+    codes = np.array([110108, 110108.9, np.nan, np.inf, -1, 440100])
+    assert divisions.valid_mask(codes).tolist() == \
+        [True, False, False, False, False, True]
+
+
+def test_take():
+    d = divisions
+    assert d.take([110108, '440100']) == [110108, 440100]
+    assert d.take([110000, 130100], 'name_en') == ['Beijing', 'Shijiazhuang']
+    with pytest.raises(InvalidCodeError):
+        d.take([110108, 990000])
+    with pytest.raises(ValueError):
+        d.take([110108], 'foo')
+
+
+def test_take_numpy():
+    np = pytest.importorskip('numpy')
+    codes = np.array([[110000, 440100], [130100, 110108]])
+
+    levels = divisions.take(codes, 'level')
+    assert levels.dtype.kind == 'i'
+    assert levels.tolist() == [[1, 2], [2, 3]]
+    assert divisions.take(codes, 'name_en')[0].tolist() == \
+        ['Beijing', 'Guangzhou']
+    assert divisions.take(codes)[1, 1] == 110108
+    with pytest.raises(InvalidCodeError):
+        divisions.take(np.array([110108, -1]))
+
+
+def test_to_arrow():
+    pytest.importorskip('pyarrow')
+    table = divisions.to_arrow()
+    assert table.num_rows == len(divisions)
+
+    rows = {row['code']: row for row in table.to_pylist()}
+    assert rows[110108]['name_en'] == 'Haidian'
+    assert rows[110108]['province_code'] == 110000
+    assert rows[110108]['prefecture_code'] == 110100
+    assert rows[110000]['prefecture_code'] is None
 
 
 def test_level():
@@ -41,6 +280,27 @@ def test_level():
         level(990000)
 
 
+def test_lookup():
+    d = divisions
+    assert d.lookup('guangzhou') == 440100  # Case-insensitive
+    assert d.lookup('440100') == 440100
+    # Fields are matched in order: code, then level
+    assert d.lookup(110000) == 110000
+    assert d.lookup(2) == 110100
+    assert d.lookup(2.0) == 110100
+
+    # Ambiguous values
+    assert d.lookup('Hainan') == 150303
+    with pytest.raises(AmbiguousRegionError):
+        d.lookup('Hainan', strict=True)
+    with pytest.raises(AmbiguousRegionError):
+        d.lookup(2, strict=True)
+    assert d.lookup('Haidian', strict=True) == 110108
+
+    assert d.lookup_many(['Guangzhou', 'bogus', 110108]) == \
+        [440100, None, 110108]
+
+
 def test_search():
     d = divisions
     # Default field
@@ -93,6 +353,230 @@ def test_search():
     assert d.search(name_zh='海淀区').name_zh == '海淀区'
 
 
+def test_search_short():
+    d = divisions
+    assert d.search(name_zh='海淀', short=True) == 110108
+    assert d.search(name_zh='海淀区', short=True) == 110108
+    assert d.search(name_zh='恩施', short=True, level=2) == 422800
+    assert d.search(name_pinyin='Haidian', short=True) == 110108
+    assert d.search(name_en='haidian qu', short=True) == 110108
+
+    # Filters
+    with pytest.raises(AmbiguousRegionError, match="short name_zh = '朝阳'"):
+        d.search(name_zh='朝阳', short=True)
+    assert d.search(name_zh='朝阳', short=True, within=110000) == 110105
+    assert d.search(name_zh='朝阳', short=True, level=2) == 211300
+    with pytest.raises(RegionKeyError):
+        d.search(name_zh='朝阳', short=True, within=120000)
+
+    with pytest.raises(ValueError):
+        d.search(alpha='BJ', short=True)
+    with pytest.raises(ValueError):
+        d.search(name_zh='海淀', short=True, partial=True)
+
+
+def test_search_traditional():
+    d = divisions
+    assert d.search(name_zh='海澱區') == 110108
+    assert d.search(name_zh='瀋陽市') == 210100
+    assert d.search(name_zh='沈陽市') == 210100
+    assert d.search(name_zh='廣州', short=True) == 440100
+    assert d.search(name_zh='廣東', partial=True) == 440000
+    assert d.lookup('臺州市') == 331000
+
+    assert d.take([110108, 210100], 'name_zh_hant') == ['海澱區', '瀋陽市']
+
+    # Names already in simplified characters are not converted
+    assert d.search(name_zh='叠彩区') == 450303
+    assert d.search_ranked(name_zh='叠彩区')[0].division == 450303
+    assert d.search(name_zh='疊彩區') == 450303
+    for div in d:
+        assert d.search(name_zh=div.name_zh, within=div.code) == div.code
+
+
+def test_search_within():
+    # within has the same meaning for every field
+    d = divisions
+    for kwargs in (dict(name_zh='天津市'), dict(name_zh='天津', short=True),
+                   dict(name_en='Tianjin')):
+        assert d.search(within=120000, **kwargs) == 120000
+        with pytest.raises(RegionKeyError):
+            d.search(within=110000, **kwargs)
+    assert d.search(name_zh='市辖区', within=120000) == 120100
+    assert d.search(name_zh='市辖区', within='120100', level=2) == 120100
+
+
+def test_search_roman():
+    d = divisions
+    for value in ('guangzhou', 'Guang Zhou', 'Guangzhou Shi', 'GUANGZHOU'):
+        assert d.search(name_en=value) == 440100
+        assert d.search(name_pinyin=value) == 440100
+        assert d.lookup(value) == 440100
+    assert d.search(name_en='xi an', level=2) == 610100
+    assert d.search(name_pinyin="Guǎngzhōu shì") == 440100
+    assert d.search(name_en='guangz', partial=True, level=2) == 440100
+
+    with pytest.raises(RegionKeyError):
+        d.search(name_en='guangzhou', within=110000)
+    with pytest.raises(AmbiguousRegionError):
+        d.lookup('chaoyang', strict=True)
+
+
+def test_search_ranked():
+    d = divisions
+    result = d.search_ranked(name_zh='朝阳', k=None)
+    assert [c.division.code for c in result] == [110105, 211300, 211321,
+                                                 220104]
+    assert all(c.match == 'short' for c in result)
+    assert len(d.search_ranked(name_zh='朝阳', k=2)) == 2
+
+    # Exact matches rank above short ones
+    result = d.search_ranked(name_zh='朝陽區', k=None)
+    assert [c.match for c in result[:2]] == ['exact', 'exact']
+    assert result[0].score > result[-1].score
+
+    # Context hints
+    def best(**context):
+        return d.search_ranked(name_en='Chaoyang', k=1,
+                               context=context)[0].division.code
+
+    assert best(within=220000) == 220104
+    assert best(within=220100) == 220104
+    assert best(near=(41.6, 120.4), level=2) == 211300
+    assert best(near=(39.9, 116.4)) == 110105
+
+    assert d.search_ranked(name_en='Nowhere') == []
+    with pytest.raises(ValueError):
+        d.search_ranked(name_zh='朝阳', context=dict(province=220000))
+    with pytest.raises(ValueError):
+        d.search_ranked(alpha='BJ')
+
+
+def test_search_cache():
+    d = Database('unified', cache_size=2)
+    assert d.cache_info() == (0, 0, 0, 2, 0)
+
+    a = d.search(name_zh='海淀区')
+    assert d.search(name_zh='海淀区') is a
+    assert d.cache_info()[:2] == (1, 1)
+
+    # Equivalent arguments share a cache entry
+    d.search(name_zh='市辖区', within='110000')
+    d.search(name_zh='市辖区', within=110000, partial=False, level=None)
+    assert d.cache_info()[:2] == (2, 2)
+
+    # Negative results are cached, and raised again
+    for i in range(2):
+        with pytest.raises(RegionKeyError):
+            d.search(name_zh='bogus')
+    assert d.cache_info() == (3, 3, 1, 2, 2)
+
+    # Reloading invalidates the cache
+    d.reload()
+    assert d.cache_info().currsize == 0
+    assert d.search(name_zh='海淀区') == a
+    assert d.cache_info().misses == 4
+
+    # Expired results
+    d = Database('unified', cache_ttl=-1)
+    d.search(name_zh='海淀区')
+    d.search(name_zh='海淀区')
+    assert d.cache_info()[:2] == (0, 2)
+
+    # Cache disabled
+    d = Database('unified', cache_size=0)
+    assert d.cache_info() is None
+    assert d.lookup('Guangzhou') == 440100
+    assert d.search(name_zh='市辖区', within='110000') == 110100
+
+
+def test_instrument():
+    d = Database('unified')
+    assert 'calls' not in d.stats()
+
+    calls = []
+    d.instrument(before=lambda name, args, kwargs: calls.append(name),
+                 after=lambda name, args, kwargs, t, e: calls.append(e))
+    d.get(110108)
+    d.get(110108)
+    d.search(name_zh='海淀区')
+    d.search(name_zh='海淀区')
+    with pytest.raises(RegionKeyError):
+        d.search(name_zh='bogus')
+
+    stats = d.stats()
+    assert stats['calls']['get']['count'] == 2
+    assert stats['calls']['search']['count'] == 3
+    assert sum(stats['calls']['search']['buckets'].values()) == 3
+    # Loading the database, and two searches
+    assert stats['sql']['count'] == 3
+    assert stats['index'] == dict(hits=2, misses=0, hit_ratio=1)
+    assert stats['cache']['hits'] == 1
+    assert calls[:2] == ['get', None]
+    assert isinstance(calls[-1], RegionKeyError)
+
+    # Methods that load the database are recorded by name
+    d.lookup('Guangzhou')
+    assert d.stats()['calls']['lookup']['count'] == 1
+
+    # Disabled
+    d.instrument(False)
+    d.get(110108)
+    assert 'calls' not in d.stats()
+
+
+def test_identity():
+    d = Database('unified', cache_size=0)
+    div = d.get(110108)
+    # Every query returns the same instance for the same code
+    assert d.search(name_zh='海淀区') is div
+    assert d.search(name_zh='海淀区') is d.search(name_en='Haidian')
+    assert d.lookup('Haidian') is div
+    assert d.stack(110108)[-1] is div
+    assert d.take([110108])[0] is div
+    assert next(x for x in d.all_at_level(3) if x.code == 110108) is div
+    assert next(x for x in d if x.code == 110108) is div
+
+
+def test_load_threads():
+    # Concurrent first queries wait for one load of the database
+    d = Database('unified')
+    results = []
+
+    def lookup():
+        try:
+            results.append(d.lookup('Guangzhou'))
+        except Exception as e:
+            results.append(e)
+
+    threads = [Thread(target=lookup) for _ in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert results == [440100] * 8
+
+
+def test_pickle():
+    div = divisions.get(110108)
+    data = pickle.dumps(div)
+    assert len(data) < 100
+    # Unpickled divisions are the same objects
+    assert pickle.loads(data) is div
+
+    # A division from a different version of the data
+    f, (name, code, version) = div.__reduce__()
+    with pytest.raises(ValueError):
+        f(name, code, version + 1)
+
+    # Databases are reloaded on first use, with the same settings
+    d = pickle.loads(pickle.dumps(Database('unified', cache_size=2)))
+    assert not d._is_loaded
+    assert d.cache_info().maxsize == 2
+    assert d.get(110108) == div
+    assert d.version == divisions.version
+
+
 def test_parent():
     assert parent(110108) == 110100
     assert parent(110100) == 110000
@@ -105,6 +589,38 @@ def test_parent():
         parent(990101)
 
 
+def test_parent_many():
+    codes = [110108, 110100, 110000, 990101, '110108', None]
+    parents, errors = parent_many(codes)
+    assert list(parents) == [110100, 110000, 0, 0, 110100, 0]
+    assert errors == bytearray([0, 0, 1, 1, 0, 1])
+
+    # Same results as parent()
+    codes = [110108, 110100, 110000]
+    for lvl in (1, 2, 3):
+        parents, errors = parent_many(codes, lvl)
+        for code, p, e in zip(codes, parents, errors):
+            if e:
+                with pytest.raises((LookupError, ValueError)):
+                    parent(code, lvl)
+            else:
+                assert parent(code, lvl) == p
+
+    with pytest.raises(ValueError):
+        parent_many(codes, 0)
+
+
+def test_parent_many_numpy():
+    np = pytest.importorskip('numpy')
+    codes = np.array([110108, 110100, 110000, 990101, -1])
+    parents, errors = parent_many(codes)
+    assert parents.tolist() == [110100, 110000, 0, 0, 0]
+    assert errors.tolist() == [False, False, True, True, True]
+
+    parents, errors = parent_many(codes, 1)
+    assert parents.tolist() == [110000, 110000, 110000, 0, 0]
+
+
 def test_split():
     assert split(331024) == (33, 10, 24)
 
@@ -0,0 +1,69 @@
+import pytest
+
+from gb2260.merge import Source, join, merge
+
+
+def test_join():
+    a = [(1, 'a1'), (3, 'a3'), (3, 'a3b')]
+    b = [(2, 'b2'), (3, 'b3')]
+    assert list(join(a, b)) == [
+        (1, ['a1', None]),
+        (2, [None, 'b2']),
+        (3, ['a3b', 'b3']),  # Last duplicate is used
+        ]
+
+    # Unsorted source
+    with pytest.raises(ValueError):
+        list(join([(2, 'a'), (1, 'b')]))
+
+
+def test_merge():
+    base = Source('base', [
+        (110000, dict(name_zh='北京市')),
+        (110100, dict(name_zh='市辖区')),
+        (120000, dict(name_zh='天津市')),
+        ])
+    other = Source('other', [
+        (110000, dict(name='北京市', en='Beijing', alpha='BJ')),
+        (110100, dict(name='市轄區', en='', alpha='XX')),
+        (130000, dict(name='河北省', en='Hebei', alpha='HE')),
+        ], fields=dict(name_en='en', name_zh='name'),
+        accept=lambda base, row: None if base['name_zh'] == row['name']
+        else 'name mismatch')
+    extra = Source('extra', [
+        (110000, dict(alpha=None)),
+        (120000, dict(name_en='Tianjin')),
+        ])
+
+    fields = dict(
+        name_zh=('first', ['base']),
+        name_en=('first', ['extra', 'other']),
+        alpha=('present', ['extra', 'other']),
+        )
+    result = list(merge(base, [other, extra], fields))
+
+    # Only codes in the base source
+    assert [entry['code'] for entry, _, _ in result] == \
+        [110000, 110100, 120000]
+
+    entry, provenance, notes = result[0]
+    assert entry == dict(code=110000, name_zh='北京市', name_en='Beijing',
+                         alpha=None)
+    assert provenance == dict(name_zh='base', name_en='other', alpha='extra')
+    assert notes == []
+
+    # Rejected row
+    entry, provenance, notes = result[1]
+    assert entry['alpha'] is None
+    assert notes == [('other', 'name mismatch'), ('extra', 'missing')]
+
+    entry, provenance, notes = result[2]
+    assert entry['name_en'] == 'Tianjin'
+    # 'extra' has a row without 'alpha'
+    assert 'alpha' not in provenance
+
+    # Invalid field specifications
+    with pytest.raises(ValueError):
+        next(merge(base, [], dict(name_zh=('foo', ['base']))))
+    with pytest.raises(ValueError):
+        next(merge(base, [], dict(name_zh=('first', ['foo']))))
@@ -0,0 +1,132 @@
+import asyncio
+import json
+
+import pytest
+
+from gb2260 import Database
+from gb2260.server import Server
+
+
+@pytest.fixture
+def client():
+    """Run a Server; yield a function that makes requests to it."""
+    loop = asyncio.new_event_loop()
+    server = Server(Database('unified'))
+    port = loop.run_until_complete(server.start('127.0.0.1', 0)) \
+        .sockets[0].getsockname()[1]
+    conn = loop.run_until_complete(asyncio.open_connection('127.0.0.1', port))
+
+    async def request(method, target, body=None, close=False):
+        reader, writer = conn
+        body = b'' if body is None else json.dumps(body).encode()
+        writer.write(('%s %s HTTP/1.1\r\nContent-Length: %d\r\n%s\r\n' % (
+            method, target, len(body), 'Connection: close\r\n' if close else ''
+            )).encode() + body)
+        status = int((await reader.readline()).split()[1])
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line == b'\r\n':
+                break
+            k, v = line.decode().split(':', 1)
+            headers[k.lower()] = v.strip()
+        data = await reader.readexactly(int(headers['content-length']))
+        return status, json.loads(data.decode()), headers
+
+    yield lambda *args, **kwargs: loop.run_until_complete(
+        request(*args, **kwargs))
+
+    conn[1].close()
+    loop.run_until_complete(server.close())
+    loop.close()
+
+
+def test_endpoints(client):
+    # All requests use the same connection
+    status, result, headers = client('GET', '/get?code=110108')
+    assert status == 200
+    assert result['name_en'] == 'Haidian'
+    assert headers['connection'] == 'keep-alive'
+
+    assert client('GET', '/get?name_en=Guangzhou')[1]['code'] == 440100
+    assert client('GET', '/search?name_zh=%E5%B8%82%E8%BE%96%E5%8C%BA'
+                         '&within=110000')[1]['code'] == 110100
+    assert client('GET', '/search?name_en=Hainan&level=1')[1]['code'] == \
+        460000
+    assert client('GET', '/search?name_zh=%E6%B5%B7%E6%B7%80'
+                         '&short=true')[1]['code'] == 110108
+    assert client('GET', '/search?name_zh=%E6%B5%B7%E6%B7%80'
+                         '&short=false')[0] == 404
+    assert [d['code'] for d in client('GET', '/stack?code=110108')[1]] == \
+        [110000, 110100, 110108]
+    assert client('GET', '/parent?code=110108&level=1')[1] == 110000
+    assert client('GET', '/within?a=331024&b=330000')[1] is True
+    assert client('GET', '/isolike?code=130100')[1] == 'CN-HE-SJW'
+    assert client('GET', '/from_isolike?value=CN-HE-SJW')[1]['code'] == \
+        130100
+
+    # Errors
+    status, result, _ = client('GET', '/get?code=990000')
+    assert status == 404
+    assert result['error'] == 'InvalidCodeError'
+    assert client('GET', '/parent')[0] == 400
+    assert client('GET', '/get?name_en=Hainan')[0] == 404
+    assert client('GET', '/get?name_en=bogus')[0] == 404
+    assert client('GET', '/get?foo=1')[0] == 400
+    assert client('GET', '/get?code%20%3D%20110108%20OR%20code=1')[0] == 400
+    assert client('GET', '/foo')[0] == 404
+    assert client('PUT', '/get')[0] == 405
+
+    status, result, _ = client('GET', '/stats')
+    assert result['requests'] == 19
+
+    status, result, headers = client('GET', '/within?a=1&b=1', close=True)
+    assert headers['connection'] == 'close'
+
+
+def test_batch(client):
+    status, result, _ = client('POST', '/get', [
+        {'code': 110108}, {'code': 990000}, {'name_en': 'Guangzhou'}])
+    assert status == 200
+    assert result[0]['result']['code'] == 110108
+    assert result[1]['error'] == 'InvalidCodeError'
+    assert result[2]['result']['code'] == 440100
+
+    status, result, _ = client('POST', '/parent', [
+        {'code': 110108}, {'code': 110108, 'level': 1}])
+    assert [r['result'] for r in result] == [110100, 110000]
+
+    assert client('POST', '/get', {'code': 110108})[0] == 400
+
+
+def test_internal_error():
+    loop = asyncio.new_event_loop()
+    server = Server(Database('unified'))
+
+    async def fail(params):
+        raise RuntimeError('fail')
+
+    server._endpoints['get'] = fail
+    status, result = loop.run_until_complete(server.dispatch('GET', '/get',
+                                                             b''))
+    assert status == 500
+    assert result['error'] == 'RuntimeError'
+
+    loop.run_until_complete(server.close())
+    loop.close()
+
+
+def test_database():
+    # Endpoints use the database given to the Server
+    loop = asyncio.new_event_loop()
+    db = Database('unified')
+    db.instrument()
+    server = Server(db)
+
+    status, result = loop.run_until_complete(server.dispatch(
+        'GET', '/parent?code=110108', b''))
+    assert result == 110100
+    assert db.stats()['calls']['stack']['count'] == 1
+
+    loop.run_until_complete(server.close())
+    loop.close()
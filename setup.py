@@ -11,6 +11,9 @@ setup(name='gb2260',
         'beautifulsoup4',
         'xpinyin',
         ],
+      extras_require={
+        'arrow': ['pyarrow'],
+        },
       tests_require=['pytest'],
       url='https://github.com/khaeru/gb2260',
       packages=find_packages(),